@@ -1,11 +1,21 @@
 import streamlit as st
-import os
+import time
+import uuid
 from dotenv import load_dotenv
-from comicToStory_audio_batching import process_entire_comic, generate_speech, translate_text
-import tempfile
 
-# Load environment variables
-load_dotenv()
+
+# Load environment variables once per server process (not on every rerun), before the
+# pipeline modules read their settings from them
+@st.cache_resource
+def load_env() -> bool:
+    return load_dotenv()
+
+
+load_env()
+
+from job_queue import JobQueue, WorkerPool, ACTIVE_STATUSES
+from story_chat import AnswerCache, StoryChat, StoryIndex, story_key
+from comicToStory_audio_batching import touch_audiobook
 
 st.set_page_config(page_title="ComicVerse: AI Comic Story & Audio Lab", layout="wide", initial_sidebar_state="expanded")
 st.markdown("""
@@ -52,15 +62,107 @@ language = st.radio("Select language:", ("English", "Hindi"), horizontal=True)
 # File uploader
 uploaded_file = st.file_uploader("Upload a comic PDF", type=["pdf"])
 
+# Seconds between reruns while a job is running
+POLL_INTERVAL = 1.0
+
+
+# One job queue and worker pool per server process, shared by every session
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    return JobQueue()
+
+
+@st.cache_resource
+def get_worker_pool() -> WorkerPool:
+    return WorkerPool().start()
+
+
+# Passage index of a story, built once per distinct story and shared by every session chatting about it
+@st.cache_resource(max_entries=32, show_spinner="Indexing the story for chat...")
+def get_story_index(key: str, _story: str, _narrations: list) -> StoryIndex:
+    return StoryIndex.build(_story, _narrations)
+
+
+# Answers to questions already asked about the same story, reused across sessions
+@st.cache_resource
+def get_answer_cache() -> AnswerCache:
+    return AnswerCache()
+
+
+jobs = get_job_queue()
+get_worker_pool().ensure_running()
+
 # Session state for story/audio
 if "story" not in st.session_state:
     st.session_state["story"] = None
-if "audio_bytes" not in st.session_state:
-    st.session_state["audio_bytes"] = None
-if "audio_path" not in st.session_state:
-    st.session_state["audio_path"] = None
-if "processing" not in st.session_state:
-    st.session_state["processing"] = False
+# Only a handle to the audiobook ("audios/<file>.mp3" under ./static) is kept per session;
+# the browser streams the file from Streamlit's static server
+if "audio_rel" not in st.session_state:
+    st.session_state["audio_rel"] = None
+if "page_narrations" not in st.session_state:
+    st.session_state["page_narrations"] = []
+# Id of this session's queued/running job, if any
+if "job_id" not in st.session_state:
+    st.session_state["job_id"] = None
+# Identifies this session as a waiter on shared (deduplicated) jobs, so its Cancel only stops
+# the job once no other session is waiting on it
+if "session_id" not in st.session_state:
+    st.session_state["session_id"] = uuid.uuid4().hex
+if "job_message" not in st.session_state:
+    st.session_state["job_message"] = None
+# This session's conversation about the current story (rolling summary + recent turns)
+if "story_chat" not in st.session_state:
+    st.session_state["story_chat"] = None
+if "chat_history" not in st.session_state:
+    st.session_state["chat_history"] = []
+
+# Pick up the result of this session's job once a worker has finished it
+job = jobs.get(st.session_state["job_id"]) if st.session_state["job_id"] else None
+if job is not None and job["status"] not in ACTIVE_STATUSES:
+    if job["status"] == "done":
+        result = job["result"]
+        if "story" in result:
+            st.session_state["story"] = result["story"]
+            st.session_state["page_narrations"] = result["narrations"]
+            # A new story starts a new conversation
+            st.session_state["story_chat"] = None
+            st.session_state["chat_history"] = []
+        st.session_state["audio_rel"] = result["audio_rel"]
+        st.session_state["job_message"] = None
+    elif job["status"] == "failed":
+        st.session_state["job_message"] = ("error", f"Generation failed: {job['error']}")
+    else:
+        st.session_state["job_message"] = ("info", "Generation cancelled.")
+    st.session_state["job_id"] = None
+    job = None
+st.session_state["processing"] = job is not None
+
+
+def audio_url(audio_rel: str) -> str:
+    # ./static/<path> is served at app/static/<path> (server.enableStaticServing in .streamlit/config.toml)
+    return f"app/static/{audio_rel}"
+
+
+def chat_bubble(role: str, content: str) -> str:
+    if role == "user":
+        return f"<div style='text-align:right;background:#e6f7ff;padding:8px 12px;border-radius:8px;margin-bottom:4px;'><b>You:</b> {content}</div>"
+    return f"<div style='text-align:left;background:#f0f2f6;padding:8px 12px;border-radius:8px;margin-bottom:8px;'><b>AI:</b> {content}</div>"
+
+
+def get_story_chat() -> StoryChat:
+    # Indexes the page narrations and story on the first question about a new story
+    if st.session_state["story_chat"] is None:
+        story, narrations = st.session_state["story"], st.session_state["page_narrations"]
+        index = get_story_index(story_key(story, narrations), story, narrations)
+        st.session_state["story_chat"] = StoryChat(index, cache=get_answer_cache())
+    return st.session_state["story_chat"]
+
+
+def start_job(job_id: str) -> None:
+    st.session_state["job_id"] = job_id
+    st.session_state["job_message"] = None
+    st.rerun()
+
 
 left_col, right_col = st.columns([1.2, 1])
 
@@ -88,109 +190,110 @@ with left_col:
             if gen_story or st.session_state.get('pending_story', False):
                 st.session_state['pending_story'] = True
                 if st.button("Generate Story Now", disabled=st.session_state["processing"]):
-                    st.session_state["processing"] = True
-                    with st.spinner("Generating story from comic PDF..."):
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_pdf:
-                            tmp_pdf.write(uploaded_file.read())
-                            tmp_pdf_path = tmp_pdf.name
-                        story = process_entire_comic(tmp_pdf_path, os.path.dirname(tmp_pdf_path), style=story_style)
-                        if language.lower() == "hindi":
-                            story = translate_text(story, target_lang="hi")
-                        st.session_state["story"] = story
-                        st.session_state["audio_bytes"] = None
-                        st.session_state["audio_path"] = None
-                    st.session_state["processing"] = False
                     st.session_state['pending_story'] = False
                     st.session_state['show_style_options'] = False
+                    start_job(jobs.submit_story(
+                        uploaded_file.getvalue(), story_style, language, waiter=st.session_state["session_id"]
+                    ))
             elif gen_both or st.session_state.get('pending_both', False):
                 st.session_state['pending_both'] = True
                 if st.button("Generate Story and Audiobook Now", disabled=st.session_state["processing"]):
-                    st.session_state["processing"] = True
-                    with st.spinner("Generating story and audio from comic PDF..."):
-                        with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_pdf:
-                            tmp_pdf.write(uploaded_file.read())
-                            tmp_pdf_path = tmp_pdf.name
-                        story = process_entire_comic(tmp_pdf_path, os.path.dirname(tmp_pdf_path), style=story_style)
-                        if language.lower() == "hindi":
-                            story = translate_text(story, target_lang="hi")
-                        st.session_state["story"] = story
-                        st.session_state["audio_bytes"] = None
-                        st.session_state["audio_path"] = None
-                        # Generate audio
-                        voice = "alloy"
-                        audio_rel = generate_speech(story, voice=voice)
-                        audio_path = os.path.join("app", "static", audio_rel) if not os.path.exists(audio_rel) else audio_rel
-                        if os.path.exists(audio_path):
-                            with open(audio_path, "rb") as audio_file:
-                                audio_bytes = audio_file.read()
-                            st.session_state["audio_bytes"] = audio_bytes
-                            st.session_state["audio_path"] = audio_path
-                        else:
-                            st.session_state["audio_bytes"] = None
-                            st.session_state["audio_path"] = None
-                    st.session_state["processing"] = False
                     st.session_state['pending_both'] = False
                     st.session_state['show_style_options'] = False
+                    start_job(jobs.submit_story(
+                        uploaded_file.getvalue(), story_style, language, with_audio=True,
+                        waiter=st.session_state["session_id"],
+                    ))
         elif gen_audio:
-            st.session_state["processing"] = True
-            with st.spinner("Generating audio from comic PDF..."):
-                if not st.session_state["story"]:
-                    st.warning("Please generate the story first by selecting a style.")
-                else:
-                    story = st.session_state["story"]
-                    voice = "alloy"
-                    audio_rel = generate_speech(story, voice=voice)
-                    audio_path = os.path.join("app", "static", audio_rel) if not os.path.exists(audio_rel) else audio_rel
-                    if os.path.exists(audio_path):
-                        with open(audio_path, "rb") as audio_file:
-                            audio_bytes = audio_file.read()
-                        st.session_state["audio_bytes"] = audio_bytes
-                        st.session_state["audio_path"] = audio_path
-                    else:
-                        st.session_state["audio_bytes"] = None
-                        st.session_state["audio_path"] = None
-            st.session_state["processing"] = False
+            if not st.session_state["story"]:
+                st.warning("Please generate the story first by selecting a style.")
+            else:
+                start_job(jobs.submit_audio(
+                    st.session_state["story"], voice="alloy", waiter=st.session_state["session_id"]
+                ))
+
+    # Progress of the running job; the page reruns every POLL_INTERVAL until it finishes
+    if job is not None:
+        with st.status(job["progress"] or "Waiting for a free worker...", expanded=True):
+            if job["partial"]:
+                st.write(job["partial"])
+            # The start of the audiobook can be played while the rest is synthesized; the URL stays
+            # the same as parts are added, so reruns don't restart playback
+            if job["partial_audio"]:
+                st.markdown(
+                    f"<audio controls preload='metadata' src='{audio_url(job['partial_audio'])}' "
+                    "style='width:100%;margin-top:10px;'></audio>",
+                    unsafe_allow_html=True,
+                )
+        if st.button("Cancel", key="cancel_job", disabled=bool(job["cancel_requested"])):
+            # Other sessions waiting on the same job keep it running; this one stops waiting either way
+            jobs.cancel(job["id"], waiter=st.session_state["session_id"])
+            st.session_state["job_id"] = None
+            st.session_state["job_message"] = ("info", "Generation cancelled.")
+            st.rerun()
+    elif st.session_state["job_message"]:
+        kind, message = st.session_state["job_message"]
+        if kind == "error":
+            st.error(message)
+        else:
+            st.info(message)
 
     # Show results
     if st.session_state["story"]:
         st.subheader(":book: Extracted Story:")
         st.write(st.session_state["story"])
         st.download_button("Download Story Text", st.session_state["story"], file_name="story.txt", key="download_text")
-    if st.session_state["audio_bytes"]:
+    # Showing the audiobook marks it as in use, so the audio store doesn't evict it mid-playback
+    if st.session_state["audio_rel"] and not touch_audiobook(st.session_state["audio_rel"]):
+        st.session_state["audio_rel"] = None
+        st.info("The audiobook has expired from the cache; generate it again to listen.")
+    if st.session_state["audio_rel"]:
         st.subheader(":loud_sound: Audiobook:")
-        st.audio(st.session_state["audio_bytes"], format="audio/mp3")
-        st.download_button("Download Audio", st.session_state["audio_bytes"], file_name="story.mp3", key="download_audio")
+        # Plain <audio>/<a> tags pointing at the static file: the browser fetches it with range
+        # requests, so nothing of the MP3 is held in server memory or re-sent on reruns
+        url = audio_url(st.session_state["audio_rel"])
+        st.markdown(
+            f"<audio controls preload='metadata' src='{url}' style='width:100%;margin-top:10px;'></audio>"
+            f"<div><a href='{url}' download='story.mp3'>Download Audio</a></div>",
+            unsafe_allow_html=True,
+        )
 
 with right_col:
     st.header("🤖 Chat with the Story")
-    if "chat_history" not in st.session_state:
-        st.session_state["chat_history"] = []
     if st.session_state["processing"]:
         st.info("Please wait until processing is complete to chat with the story.")
     elif st.session_state["story"]:
         chat_container = st.container()
         with chat_container:
             for entry in st.session_state["chat_history"]:
-                if entry["role"] == "user":
-                    st.markdown(f"<div style='text-align:right;background:#e6f7ff;padding:8px 12px;border-radius:8px;margin-bottom:4px;'><b>You:</b> {entry['content']}</div>", unsafe_allow_html=True)
-                else:
-                    st.markdown(f"<div style='text-align:left;background:#f0f2f6;padding:8px 12px;border-radius:8px;margin-bottom:8px;'><b>AI:</b> {entry['content']}</div>", unsafe_allow_html=True)
+                st.markdown(chat_bubble(entry["role"], entry["content"]), unsafe_allow_html=True)
         user_query = st.text_input("Ask a question about the story:", key="chat_input", disabled=st.session_state["processing"])
         if st.button("Send", key="send_btn", disabled=st.session_state["processing"] or not user_query):
             st.session_state["chat_history"].append({"role": "user", "content": user_query})
-            with st.spinner("Getting answer from model..."):
-                import openai
-                chat_prompt = (
-                    f"Story:\n{st.session_state['story']}\n\nUser question: {user_query}\n\nAnswer as helpfully as possible, referencing the story above."
-                )
-                response = openai.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[{"role": "user", "content": chat_prompt}],
-                    temperature=0.7,
-                    max_tokens=300,
-                )
-                answer = response.choices[0].message.content.strip()
-                st.session_state["chat_history"].append({"role": "ai", "content": answer})
-            st.rerun()
+            with chat_container:
+                st.markdown(chat_bubble("user", user_query), unsafe_allow_html=True)
+                # Only the most relevant passages and a bounded summary of the conversation are sent;
+                # the answer is shown as it streams in
+                reply = st.empty()
+                answer = ""
+                try:
+                    for text in get_story_chat().iter_answer(user_query):
+                        answer += text
+                        reply.markdown(chat_bubble("ai", answer), unsafe_allow_html=True)
+                except Exception as e:
+                    # Keep the rest of the page working; the question can be sent again
+                    st.session_state["chat_history"].pop()
+                    reply.error(f"Could not answer the question: {e}")
+                    answer = None
+            if answer is not None:
+                st.session_state["chat_history"].append({"role": "ai", "content": answer.strip()})
+                st.rerun()
+        answer_cache = get_answer_cache()
+        answered = answer_cache.stats["hits"] + answer_cache.stats["semantic_hits"]
+        st.caption(f"{answered} of {answered + answer_cache.stats['misses']} questions answered from cache ({answer_cache.hit_rate():.0%})")
     else:
         st.info("Generate the story or audio first to chat with the AI.")
+
+if st.session_state["processing"]:
+    time.sleep(POLL_INTERVAL)
+    st.rerun()
@@ -0,0 +1,60 @@
+"""
+Times how long it takes to import each pipeline module in a fresh interpreter.
+
+Usage:
+    python bench_imports.py [--runs 5]
+
+Each module is imported in its own subprocess so nothing is cached between runs;
+the median of the runs is reported. Run with `python -X importtime` on a single
+module to see which of its imports dominate.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# (module, directory it is imported from)
+MODULES = [
+    ("comicToStory_audio_batching", ROOT),
+    ("job_queue", ROOT),
+    ("utils", os.path.join(ROOT, "eval")),
+    ("pipeline", os.path.join(ROOT, "eval")),
+    ("eval", os.path.join(ROOT, "eval")),
+]
+
+TIMER = (
+    "import time, importlib; t = time.perf_counter(); "
+    "importlib.import_module({module!r}); print(time.perf_counter() - t)"
+)
+
+
+def time_import(module: str, cwd: str) -> float:
+    out = subprocess.run(
+        [sys.executable, "-c", TIMER.format(module=module)],
+        cwd=cwd, capture_output=True, text=True, check=True,
+    ).stdout
+    return float(out.strip().splitlines()[-1])
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark cold import time of the pipeline modules.")
+    parser.add_argument("--runs", type=int, default=5, help="Fresh interpreters per module (default 5).")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for module, cwd in MODULES:
+        try:
+            times = [time_import(module, cwd) for _ in range(args.runs)]
+        except subprocess.CalledProcessError as e:
+            print(f"{module:<30} import failed: {e.stderr.strip().splitlines()[-1]}")
+            failed = True
+            continue
+        print(f"{module:<30} median {statistics.median(times) * 1000:7.1f} ms   min {min(times) * 1000:7.1f} ms")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
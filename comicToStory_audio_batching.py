@@ -1,107 +1,274 @@
-from dotenv import load_dotenv
+import argparse
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import math
 import os
+import queue
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+from collections import deque, namedtuple
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait,
+)
+from dataclasses import dataclass
+from typing import Callable, Iterable, Iterator, List, Optional
+
+from dotenv import load_dotenv
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image
 
-# Print the current working directory to verify where Python is looking for the .env file
-print("Current working directory:", os.getcwd())
+# Importing this module does no work: app.py / eval load the .env file themselves before importing it,
+# and the batch CLI (python -m comicToStory_audio_batching) loads it here, before comicverse_common
+# and the settings below are read
+if __name__ == "__main__":
+    load_dotenv()
 
-# Load the .env file
-load_dotenv()
+# Workspaces, the retry layer, batch planning and the OCR cache are shared with eval/
+from comicverse_common import (
+    CACHE_DIR, MAX_PAGES_PER_BATCH, BatchPlanner, CircuitOpenError, PlannedBatch, RateLimiter, api_breaker,
+    api_limiter, backoff_delay, call_with_retry, check_workspace_quota, estimate_image_tokens,
+    estimate_output_tokens, estimate_request_tokens, get_ocr_cache, get_pytesseract, init_ocr_worker,
+    job_workspace, openai, record_retry_stats, retry_after_seconds, retryable_errors,
+)
 
-# Print the API key (first few characters for security)
-api_key = os.getenv("OPENAI_API_KEY")
-if api_key:
-    print("API key found:", api_key[:4] + "..." + api_key[-4:])
-else:
-    print("No API key found")
 #--------------------------------------------
 # PDF → Images
 #--------------------------------------------
 
-from pdf2image import convert_from_path
-import os
+# Poppler's bin directory (e.g. C:\poppler-23.11.0\Library\bin on Windows); unset to use the one on PATH
+POPPLER_PATH = os.getenv("POPPLER_PATH") or None
 
+# Set COMICVERSE_DEBUG_PAGES=1 to also write every rendered page to disk
+DEBUG_PAGES = os.getenv("COMICVERSE_DEBUG_PAGES") == "1"
 
+# Disk quota for one job's workspace (rendered pages etc.)
+WORKSPACE_QUOTA_BYTES = int(os.getenv("COMICVERSE_WORKSPACE_QUOTA_MB", "512")) * 1024 * 1024
+
+
+@dataclass
+class ComicPage:
+    """
+    One rendered page, encoded once as the JPEG that is both OCR'd and sent to the model.
+    """
+    index: int                  # 0-based page index
+    jpeg: bytes
+    width: int
+    height: int
+    path: Optional[str] = None  # only set when the page was also written to disk
+
+
+def _iter_rendered(pdf_path: str, dpi: int, poppler_path: str, window: int) -> Iterator[tuple]:
+    """
+    Rasterizes the PDF `window` pages at a time and yields (page number, PIL image),
+    so at most `window` pages are held in memory however long the PDF is.
+    """
+    page_count = pdfinfo_from_path(pdf_path, poppler_path=poppler_path)["Pages"]
+    for first in range(1, page_count + 1, window):
+        last = min(first + window - 1, page_count)
+        pages = convert_from_path(
+            pdf_path, dpi=dpi, poppler_path=poppler_path, first_page=first, last_page=last
+        )
+        for i in range(first, last + 1):
+            if not pages:
+                break
+            page = pages.pop(0)
+            try:
+                yield i, page
+            finally:
+                page.close()
+
+
+def iter_rendered_pages(
+    pdf_path: str,
+    dpi: int = 150,
+    image_quality: int = 60,
+    scale_factor: float = 0.4,
+    poppler_path: Optional[str] = POPPLER_PATH,
+    window: int = 4,
+    debug_dir: Optional[str] = None,
+    quota_bytes: Optional[int] = None
+) -> Iterator[ComicPage]:
+    """
+    Renders each page straight at its final resolution (dpi * scale_factor) and encodes it
+    once as an in-memory JPEG. Pages are only written to disk when debug_dir is given;
+    raises WorkspaceQuotaExceeded once debug_dir grows past quota_bytes.
+    """
+    if debug_dir:
+        os.makedirs(debug_dir, exist_ok=True)
+    for number, page in _iter_rendered(pdf_path, round(dpi * scale_factor), poppler_path, window):
+        buffer = io.BytesIO()
+        page.convert("RGB").save(buffer, "JPEG", quality=image_quality, optimize=True, progressive=True)
+        jpeg = buffer.getvalue()
+
+        path = None
+        if debug_dir:
+            path = os.path.join(debug_dir, f"page_{number:03d}.jpg")
+            with open(path, "wb") as f:
+                f.write(jpeg)
+            check_workspace_quota(debug_dir, quota_bytes)
+        yield ComicPage(number - 1, jpeg, page.width, page.height, path)
+
+
+def iter_pdf_pages(
+    pdf_path: str,
+    output_folder: str,
+    dpi: int = 150,
+    image_quality: int = 60,
+    scale_factor: float = 0.4,
+    poppler_path: Optional[str] = POPPLER_PATH,
+    window: int = 4,
+    quota_bytes: Optional[int] = None
+) -> Iterator[str]:
+    """
+    Rasterizes the PDF `window` pages at a time and yields each compressed JPEG path
+    as soon as it is written, so at most `window` full-size pages are held in memory.
+    Raises WorkspaceQuotaExceeded once output_folder grows past quota_bytes.
+    """
+    os.makedirs(output_folder, exist_ok=True)
+    pages = iter_rendered_pages(
+        pdf_path, dpi, image_quality, scale_factor, poppler_path, window,
+        debug_dir=output_folder, quota_bytes=quota_bytes
+    )
+    for page in pages:
+        yield page.path
 
 
-from pdf2image import convert_from_path
-from PIL import Image
-import os
- 
 def pdf_to_images(
     pdf_path: str,
     output_folder: str,
     dpi: int = 150,
     image_quality: int = 60,
     scale_factor: float = 0.4,
-    poppler_path: str = r"C:\poppler-23.11.0\Library\bin"
+    poppler_path: Optional[str] = POPPLER_PATH
 ) -> list[str]:
     """
     Converts PDF to compressed JPEG images with reduced size and quality.
     """
-    os.makedirs(output_folder, exist_ok=True)
-    pages = convert_from_path(pdf_path, dpi=dpi, poppler_path=poppler_path)
- 
-    image_paths = []
-    for i, page in enumerate(pages, start=1):
-        # Resize
-        width, height = page.size
-        new_size = (int(width * scale_factor), int(height * scale_factor))
-        page = page.resize(new_size, resample=Image.LANCZOS)
- 
-        # Save as JPEG with compression
-        img_filename = os.path.join(output_folder, f"page_{i:03d}.jpg")
-        page.save(img_filename, "JPEG", quality=image_quality, optimize=True, progressive=True)
-        image_paths.append(img_filename)
- 
-    return image_paths
+    return list(iter_pdf_pages(pdf_path, output_folder, dpi, image_quality, scale_factor, poppler_path))
+
 #--------------------------------------------
 # OCR extraction
 #--------------------------------------------
 
-import pytesseract
-from PIL import Image
+def _image_source(image):
+    # Pages may be given as a file path, encoded image bytes or a ComicPage
+    return image.jpeg if isinstance(image, ComicPage) else image
 
-# 1) Tesseract executable path:
-pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
 
-def run_ocr_on_image(image_path: str, lang: str = "eng") -> str:
+def run_ocr_on_image(image, lang: str = "eng") -> str:
     """
-    Runs Tesseract OCR on the given image and returns the recognized text.
+    Runs Tesseract OCR on the given image (a path, encoded bytes or ComicPage) and returns the recognized text.
     """
-    img = Image.open(image_path)
-    text = pytesseract.image_to_string(img, lang=lang)
+    source = _image_source(image)
+    img = Image.open(io.BytesIO(source) if isinstance(source, bytes) else source)
+    text = get_pytesseract().image_to_string(img, lang=lang)
     return text
 
 
-import openai
-import base64
+def iter_ocr_results(
+    image_paths: Iterable,
+    workers: int = None,
+    tesseract_threads: int = 1,
+    lang: str = "eng",
+    dpi: int = None,
+    use_cache: bool = True
+) -> Iterator[tuple]:
+    """
+    Runs OCR over image_paths (paths, encoded bytes or ComicPages) on a process pool
+    and yields (image, text) in input order.
+    Pages already in the OCR cache are served from it; new results are stored.
+    At most 2 * workers images are in flight, so image_paths may be a lazy generator.
+    """
+    cache = get_ocr_cache() if use_cache else None
+    workers = workers or os.cpu_count() or 1
+    pool = ProcessPoolExecutor(
+        max_workers=workers, initializer=init_ocr_worker, initargs=(tesseract_threads,)
+    )
+    pending = deque()
+
+    def finish():
+        done_image, future, image_bytes = pending.popleft()
+        text = future.result()
+        if image_bytes is not None:
+            cache.put(image_bytes, text, dpi, lang)
+        return done_image, text
+
+    try:
+        for image in image_paths:
+            source = _image_source(image)
+            image_bytes = None
+            if cache is not None:
+                if isinstance(source, bytes):
+                    image_bytes = source
+                else:
+                    with open(source, "rb") as f:
+                        image_bytes = f.read()
+                cached = cache.get(image_bytes, dpi, lang)
+                if cached is not None:
+                    future = Future()
+                    future.set_result(cached)
+                    pending.append((image, future, None))
+                    continue
+            pending.append((image, pool.submit(run_ocr_on_image, source, lang), image_bytes))
+            if len(pending) >= 2 * workers:
+                yield finish()
+        while pending:
+            yield finish()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def run_ocr_on_images(
+    image_paths: List[str],
+    workers: int = None,
+    tesseract_threads: int = 1,
+    lang: str = "eng",
+    dpi: int = None,
+    use_cache: bool = True
+) -> List[str]:
+    """
+    Runs OCR on many images in parallel worker processes, reusing cached results.
+    Returns the recognized texts in the same order as image_paths.
+    """
+    return [
+        text for _, text in iter_ocr_results(image_paths, workers, tesseract_threads, lang, dpi, use_cache)
+    ]
 
 #--------------------------------------------
 # Page summarization
 #--------------------------------------------
 
-import openai
-import base64
-from typing import List, Optional
+def encode_image_url(image) -> str:
+    """
+    Returns the base64 data URL for a page given as a path, JPEG bytes or ComicPage,
+    labelled with its real MIME type.
+    """
+    source = _image_source(image)
+    if isinstance(source, bytes):
+        data, mime = source, "image/jpeg"
+    else:
+        with open(source, "rb") as f:
+            data = f.read()
+        mime = "image/png" if source.lower().endswith(".png") else "image/jpeg"
+    return f"data:{mime};base64,{base64.b64encode(data).decode('utf-8')}"
 
 
-def describe_comic_pages_with_gpt4o(
-    image_paths: List[str],
-    ocr_texts: Optional[List[str]] = None,
-    model: str = "gpt-4o-mini",
-    temperature: float = 0.7,
-    max_tokens: int = 600
-) -> str:
+def _build_narration_messages(
+    image_paths: List, ocr_texts: Optional[List[str]] = None, structured: bool = False
+) -> List[dict]:
     """
-    Sends up to 5 comic pages + OCR texts in one batch to GPT-4o.
-    Asks GPT to return separate page narrations prefixed with 'Page 1:', 'Page 2:', etc.
-    Returns the raw combined string of page narrations.
+    Builds the chat messages asking GPT-4o to narrate each page image, with optional OCR text.
+    Images may be paths, JPEG bytes or ComicPages. With structured=True the model is asked for
+    JSON matching PAGE_NARRATIONS_FORMAT instead of 'Page N:' labels.
     """
-    if not image_paths:
-        raise ValueError("At least one image path must be provided.")
-    if len(image_paths) > 5:
-        raise ValueError("A maximum of 5 images can be processed at once.")
-
     # Prepare OCR texts
     if ocr_texts is None:
         ocr_texts = [""] * len(image_paths)
@@ -110,20 +277,25 @@ def describe_comic_pages_with_gpt4o(
 
     # Encode images
     blocks: List[dict] = []
-    for img_path in image_paths:
-        with open(img_path, "rb") as f:
-            img_b64 = base64.b64encode(f.read()).decode("utf-8")
+    for image in image_paths:
         blocks.append({
             "type": "image_url",
-            "image_url": {"url": f"data:image/png;base64,{img_b64}"}
+            "image_url": {"url": encode_image_url(image)}
         })
 
     # Build prompt: ask for labeled narrations
-    prompt = (
-        "You are a comic-book interpreter. For each image I send, please provide a detailed narration "
-        "of that page, labeling each section with 'Page 1:', 'Page 2:', etc., in order. "
-        "Include characters, actions, settings, and dialogues."
-    )
+    if structured:
+        prompt = (
+            "You are a comic-book interpreter. For each image I send, please provide a detailed narration "
+            "of that page. Include characters, actions, settings, and dialogues. Return one entry per image, "
+            "with page_index set to the image's position in this message (1 for the first image, 2 for the second, etc.)."
+        )
+    else:
+        prompt = (
+            "You are a comic-book interpreter. For each image I send, please provide a detailed narration "
+            "of that page, labeling each section with 'Page 1:', 'Page 2:', etc., in order. "
+            "Include characters, actions, settings, and dialogues."
+        )
 
     # Combine user content: prompt, images, OCR
     user_content = [{"type": "text", "text": prompt}]
@@ -135,149 +307,1265 @@ def describe_comic_pages_with_gpt4o(
                 "text": f"OCR for Page {idx}:\n" + ocr_texts[idx-1].strip()
             })
 
+    return [
+        {"role": "system", "content": "You are a helpful assistant that reads comics."},
+        {"role": "user", "content": user_content}
+    ]
+
+
+def describe_comic_pages_with_gpt4o(
+    image_paths: List[str],
+    ocr_texts: Optional[List[str]] = None,
+    model: str = "gpt-4o-mini",
+    temperature: float = 0.7,
+    max_tokens: int = 600
+) -> str:
+    """
+    Sends up to MAX_PAGES_PER_BATCH comic pages (paths, JPEG bytes or ComicPages) + OCR texts
+    in one batch to GPT-4o; use BatchPlanner to size batches and max_tokens.
+    Asks GPT to return separate page narrations prefixed with 'Page 1:', 'Page 2:', etc.
+    Returns the raw combined string of page narrations.
+    """
+    if not image_paths:
+        raise ValueError("At least one image path must be provided.")
+    if len(image_paths) > MAX_PAGES_PER_BATCH:
+        raise ValueError(f"A maximum of {MAX_PAGES_PER_BATCH} images can be processed at once.")
+
     # Call GPT-4o
-    response = openai.chat.completions.create(
+    response = call_with_retry(
+        openai.chat.completions.create,
         model=model,
-        messages=[
-            {"role": "system", "content": "You are a helpful assistant that reads comics."},
-            {"role": "user", "content": user_content}
-        ],
+        messages=_build_narration_messages(image_paths, ocr_texts),
         temperature=temperature,
         max_tokens=max_tokens,
     )
     return response.choices[0].message.content.strip()
 
+
+# JSON schema for structured page narrations (response_format)
+PAGE_NARRATIONS_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "page_narrations",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "pages": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "page_index": {"type": "integer"},
+                            "narration": {"type": "string"},
+                        },
+                        "required": ["page_index", "narration"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["pages"],
+            "additionalProperties": False,
+        },
+    },
+}
+
+
+def parse_structured_narrations(content: str, n_pages: int) -> dict:
+    """
+    Reads a PAGE_NARRATIONS_FORMAT response.
+    Returns {page number within the batch (1-based): narration}; pages that are missing,
+    empty or out of range are left out, and unparseable (e.g. truncated) JSON yields {}.
+    """
+    try:
+        pages = json.loads(content)["pages"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return {}
+    narrations = {}
+    for page in pages:
+        try:
+            page_num = int(page["page_index"])
+            text = str(page["narration"]).strip()
+        except (KeyError, TypeError, ValueError):
+            continue
+        if 1 <= page_num <= n_pages and text:
+            narrations[page_num] = text
+    return narrations
+
+
+def parse_page_narrations(combined: str, n_pages: int) -> dict:
+    """
+    Extracts the 'Page X: ...' blocks from a batch narration.
+    Returns {page number within the batch (1-based): narration}, ignoring labels outside 1..n_pages.
+    """
+    pattern = r"Page\s*(\d+):\s*(.*?)(?=Page\s*\d+:|$)"
+    narrations = {}
+    for match in re.finditer(pattern, combined, re.DOTALL):
+        page_num = int(match.group(1))
+        if 1 <= page_num <= n_pages:
+            narrations[page_num] = match.group(2).strip()
+    return narrations
+
+def estimate_page_input_tokens(page: "ComicPage", ocr_text: str) -> int:
+    """
+    Estimated prompt tokens for one page: its image plus its OCR text.
+    """
+    return estimate_image_tokens(page.width, page.height) + len(ocr_text.strip()) // 4 + 10
+
 #--------------------------------------------
-# Story Aggregation and final story
+# Concurrent narration dispatch
 #--------------------------------------------
 
-import re 
+class NarrationScheduler:
+    """
+    Sends page-narration batches to the chat-completions API concurrently from a
+    background asyncio loop, limited by max_concurrency and by the requests/min and tokens/min
+    buckets of `limiter`, which defaults to the process-wide api_limiter shared with every other call.
+    Retryable errors (429, timeouts, 5xx) are retried through the shared retry layer's
+    Retry-After handling, jittered backoff, circuit breaker and RETRY_STATS counters.
+    In structured mode (the default) narrations come back as JSON keyed by page, and any page
+    the model skipped is re-requested on its own instead of re-sending the whole batch.
+    Point base_url (or OPENAI_BASE_URL) at a local fake server to exercise it offline.
+
+        with NarrationScheduler() as scheduler:
+            futures = [scheduler.submit(indices, imgs, ocrs) for indices, imgs, ocrs in batches]
+            narrations = scheduler.collect(futures)   # {absolute page index: narration}
+    """
+    def __init__(
+        self,
+        model: str = "gpt-4o-mini",
+        temperature: float = 0.7,
+        max_tokens: int = 600,
+        max_concurrency: int = 4,
+        limiter: Optional[RateLimiter] = None,
+        max_retries: int = 5,
+        base_url: str = None,
+        structured: bool = True
+    ):
+        self.model = model
+        self.structured = structured
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.max_retries = max_retries
+        self._limiter = limiter or api_limiter
+        self._slots = asyncio.Semaphore(max_concurrency)
+        # Retries are handled here so they go back through the rate-limit buckets
+        self._client = openai.AsyncOpenAI(base_url=base_url, max_retries=0)
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def submit(
+        self,
+        page_indices: List[int],
+        image_paths: List,
+        ocr_texts: Optional[List[str]] = None,
+        max_tokens: Optional[int] = None,
+        input_tokens: Optional[int] = None
+    ) -> Future:
+        """
+        Queues one batch of pages (paths, JPEG bytes or ComicPages); page_indices holds
+        the absolute (0-based) index of each image. max_tokens and input_tokens come from
+        the BatchPlanner when available. Images are encoded on the calling thread; the
+        returned future resolves to {absolute page index: narration}.
+        """
+        if not image_paths:
+            raise ValueError("At least one image path must be provided.")
+        if len(page_indices) != len(image_paths):
+            raise ValueError("The number of page indices must match the number of image paths.")
+        if ocr_texts is None:
+            ocr_texts = [""] * len(image_paths)
+        messages = _build_narration_messages(image_paths, ocr_texts, structured=self.structured)
+        max_tokens = max_tokens or self.max_tokens
+        if input_tokens is None:
+            budget = estimate_request_tokens(messages, max_tokens)
+        else:
+            budget = input_tokens + max_tokens
+        pages = list(zip(image_paths, ocr_texts))
+        return asyncio.run_coroutine_threadsafe(
+            self._narrate(list(page_indices), pages, messages, max_tokens, budget), self._loop
+        )
+
+    async def _narrate(
+        self, page_indices: List[int], pages: List[tuple], messages: List[dict], max_tokens: int, budget: int
+    ) -> dict:
+        n_pages = len(page_indices)
+        content = await self._complete(messages, max_tokens, budget)
+        if not self.structured:
+            parsed = parse_page_narrations(content, n_pages)
+            return {page_indices[page_num - 1]: text for page_num, text in parsed.items()}
+
+        parsed = parse_structured_narrations(content, n_pages)
+        missing = [page_num for page_num in range(1, n_pages + 1) if page_num not in parsed]
+        if missing:
+            # Re-request only the pages the model skipped, one page per call
+            single_max_tokens = max(300, max_tokens // n_pages + 100)
+            retries = []
+            for page_num in missing:
+                image, ocr_text = pages[page_num - 1]
+                single = _build_narration_messages([image], [ocr_text], structured=True)
+                retries.append(self._complete(
+                    single, single_max_tokens, estimate_request_tokens(single, single_max_tokens)
+                ))
+            for page_num, single_content in zip(missing, await asyncio.gather(*retries)):
+                narration = parse_structured_narrations(single_content, 1).get(1)
+                if narration:
+                    parsed[page_num] = narration
+        return {page_indices[page_num - 1]: text for page_num, text in parsed.items()}
+
+    async def _complete(self, messages: List[dict], max_tokens: int, budget: int) -> str:
+        extra = {"response_format": PAGE_NARRATIONS_FORMAT} if self.structured else {}
+        async with self._slots:
+            try:
+                api_breaker.check()
+            except CircuitOpenError:
+                record_retry_stats(rejected=1)
+                raise
+            record_retry_stats(calls=1)
+            for attempt in range(self.max_retries + 1):
+                # Every attempt, retries included, waits for its share of the shared rate limit
+                await asyncio.sleep(self._limiter.reserve(budget))
+                try:
+                    response = await self._client.chat.completions.create(
+                        model=self.model,
+                        messages=messages,
+                        temperature=self.temperature,
+                        max_tokens=max_tokens,
+                        **extra,
+                    )
+                    break
+                except retryable_errors() as e:
+                    if attempt == self.max_retries:
+                        api_breaker.record_failure()
+                        record_retry_stats(failures=1)
+                        raise
+                    delay = retry_after_seconds(e)
+                    if delay is None:
+                        delay = backoff_delay(attempt)
+                    record_retry_stats(retries=1, backoff_seconds=delay)
+                    await asyncio.sleep(delay)
+            api_breaker.record_success()
+        return (response.choices[0].message.content or "").strip()
 
+    @staticmethod
+    def collect(futures: List[Future]) -> dict:
+        """
+        Waits for all submitted batches and merges their narrations by absolute page index.
+        """
+        narrations = {}
+        for future in futures:
+            narrations.update(future.result())
+        return narrations
 
-def process_entire_comic(pdf_path: str, temp_folder: str, style: str = None) -> str:
+    def close(self) -> None:
+        asyncio.run_coroutine_threadsafe(self._client.close(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+#--------------------------------------------
+# Page narration cache
+#--------------------------------------------
+
+# Bump whenever the narration prompt in _build_narration_messages changes
+NARRATION_PROMPT_VERSION = "2"
+
+
+class NarrationCache:
     """
-    1. Convert PDF → images in temp_folder.
-    2. Run OCR on each.
-    3. Batch images in chunks of 5, calling GPT-4o for page-wise narrations.
-    4. Parse and collect per-page summaries with robust regex.
-    5. Combine all summaries into a cohesive short story.
-    Returns the final combined story text.
+    On-disk SQLite cache of page narrations, keyed by a hash of the page image bytes,
+    OCR text, model, temperature and prompt version. Chapter synopses are stored here too
+    (see synopsis_key). Least recently used entries are evicted once the stored narrations
+    exceed max_bytes.
     """
-    # Step A: Convert PDF → PNGs
-    page_images = pdf_to_images(pdf_path, temp_folder)
+    def __init__(self, path: str = None, max_bytes: int = 64 * 1024 * 1024):
+        self.path = path or os.path.join(CACHE_DIR, "narrations.sqlite")
+        self.max_bytes = max_bytes
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS narrations ("
+                "key TEXT PRIMARY KEY, narration TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.commit()
+        finally:
+            conn.close()
 
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
 
-    # Step B: OCR
-    ocr_texts = [run_ocr_on_image(p) for p in page_images]
+    @staticmethod
+    def make_key(
+        image_bytes: bytes,
+        ocr_text: str,
+        model: str,
+        temperature: float,
+        prompt_version: str = NARRATION_PROMPT_VERSION
+    ) -> str:
+        digest = hashlib.sha256(image_bytes)
+        for part in (ocr_text, model, repr(temperature), prompt_version):
+            digest.update(b"\0" + part.encode("utf-8"))
+        return digest.hexdigest()
 
+    def get(self, key: str) -> Optional[str]:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT narration FROM narrations WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE narrations SET last_used = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            return row[0]
+        finally:
+            conn.close()
 
+    def put(self, key: str, narration: str) -> None:
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO narrations (key, narration, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, narration, len(narration.encode("utf-8")), time.time()),
+            )
+            self._evict(conn)
+            conn.commit()
+        finally:
+            conn.close()
 
-    # Step C: Batch describe pages
-    page_summaries: List[str] = []
-    for i in range(0, len(page_images), 5):
-        chunk_imgs = page_images[i : i + 5]
-        chunk_ocr = ocr_texts[i : i + 5]
-        combined = describe_comic_pages_with_gpt4o(chunk_imgs, chunk_ocr)
-        # Use regex to extract 'Page X: ...' blocks
-        pattern = r"Page\s*(\d+):\s*(.*?)(?=Page\s*\d+:|$)"
-        matches = re.finditer(pattern, combined, re.DOTALL)
-        for match in matches:
-            page_num = int(match.group(1))
-            text = match.group(2).strip()
-            # Insert at correct absolute page index
-            absolute_index = i + (page_num - 1)
-            if absolute_index < len(page_images):
-                page_summaries.append(text)
+    def _evict(self, conn: sqlite3.Connection) -> None:
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM narrations").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for key, size in conn.execute("SELECT key, size FROM narrations ORDER BY last_used"):
+            if total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+        conn.executemany("DELETE FROM narrations WHERE key = ?", stale)
 
-    # Step D: Aggregate all page_summaries into one story
-    aggregate_prompt = (
-        "I have a comic that spans several pages. For each page, I already have a detailed "
-        "narration of what is happening (in chronological order). Here are the narrations:\n\n"
+
+_narration_cache = None
+
+
+def get_narration_cache() -> NarrationCache:
+    """
+    Returns the process-wide narration cache, creating it on first use.
+    """
+    global _narration_cache
+    if _narration_cache is None:
+        _narration_cache = NarrationCache()
+    return _narration_cache
+
+#--------------------------------------------
+# Pipelined rendering + OCR
+#--------------------------------------------
+
+_STAGE_DONE = object()
+
+
+class _StageFailed:
+    """Carries an exception raised inside a pipeline stage to the consuming thread."""
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def _put_until_stopped(q: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _iter_queue(q: queue.Queue, stop: threading.Event):
+    """
+    Yields items from a stage queue until its producer is done.
+    Errors raised by the producer are re-raised here.
+    """
+    while not stop.is_set():
+        try:
+            item = q.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is _STAGE_DONE:
+            return
+        if isinstance(item, _StageFailed):
+            raise item.error
+        yield item
+
+
+def _start_stage(items, work, out_q: queue.Queue, stop: threading.Event) -> threading.Thread:
+    """
+    Applies `work` to each of `items` on a background thread and feeds the results,
+    in order, into the bounded `out_q`. Blocks when the consumer falls behind.
+    """
+    def run():
+        try:
+            for item in items:
+                if not _put_until_stopped(out_q, work(item), stop):
+                    return
+        except BaseException as e:
+            _put_until_stopped(out_q, _StageFailed(e), stop)
+            return
+        _put_until_stopped(out_q, _STAGE_DONE, stop)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def iter_ocr_pages(
+    pdf_path: str,
+    temp_folder: str,
+    queue_size: int = 5,
+    ocr_workers: int = None,
+    dpi: int = 150,
+    quota_bytes: Optional[int] = None,
+    debug_pages: bool = DEBUG_PAGES
+) -> Iterator[tuple]:
+    """
+    Yields (ComicPage, ocr_text) for each page in order. Pages stay in memory and are only
+    written to temp_folder when debug_pages is set.
+    Rendering and OCR (on a process pool) run on their own threads with bounded queues between them,
+    so later pages are prepared while the caller is waiting on the model.
+    """
+    stop = threading.Event()
+    rendered: queue.Queue = queue.Queue(maxsize=queue_size)
+    ocred: queue.Queue = queue.Queue(maxsize=queue_size)
+
+    pages = iter_rendered_pages(
+        pdf_path, dpi=dpi, debug_dir=temp_folder if debug_pages else None, quota_bytes=quota_bytes
     )
-    for idx, desc in enumerate(page_summaries, start=1):
-        aggregate_prompt += f"--- Page {idx} ---\n{desc}\n\n"
-    # Add style instruction
-    if style == "Dramatic":
-        aggregate_prompt += (
-            "Please combine and rewrite all of these page descriptions into a single, coherent short story. "
-            "Make the story dramatic, with emotional highs and lows, suspense, and vivid descriptions. "
-            "Keep it concise (about 300–400 words), maintain narrative flow, and preserve character names or details."
-        )
-    elif style == "Fun":
-        aggregate_prompt += (
-            "Please combine and rewrite all of these page descriptions into a single, coherent short story. "
-            "Make the story fun, light-hearted, and humorous, with playful language and amusing moments. "
-            "Keep it concise (about 300–400 words), maintain narrative flow, and preserve character names or details."
-        )
-    else:  # Neutral or None
-        aggregate_prompt += (
-            "Please combine and rewrite all of these page descriptions into a single, coherent short story. "
-            "Keep a neutral, straightforward tone. Keep it concise (about 300–400 words), maintain narrative flow, and preserve character names or details."
-        )
+    _start_stage(pages, lambda page: page, rendered, stop)
+    _start_stage(
+        iter_ocr_results(_iter_queue(rendered, stop), ocr_workers, dpi=dpi), lambda page: page, ocred, stop
+    )
+    try:
+        yield from _iter_queue(ocred, stop)
+    finally:
+        stop.set()
+
+#--------------------------------------------
+# Story Aggregation and final story
+#--------------------------------------------
+
+# Estimated tokens of page narrations that fit in the final story prompt; only comics whose
+# narrations exceed this (long graphic novels) are first reduced to chapter synopses
+AGGREGATION_MAX_PROMPT_TOKENS = int(os.getenv("COMICVERSE_AGGREGATION_MAX_TOKENS", "32000"))
+# Max sections condensed into one chapter synopsis
+AGGREGATION_FAN_IN = int(os.getenv("COMICVERSE_AGGREGATION_FAN_IN", "12"))
+# Bump whenever the chapter synopsis prompt in summarize_chapter changes
+SYNOPSIS_PROMPT_VERSION = "1"
 
-    
-    response = openai.chat.completions.create(
+STYLE_INSTRUCTIONS = {
+    "Dramatic": "Make the story dramatic, with emotional highs and lows, suspense, and vivid descriptions. ",
+    "Fun": "Make the story fun, light-hearted, and humorous, with playful language and amusing moments. ",
+}
+
+
+def _section_label(first: int, last: int) -> str:
+    return f"Page {first}" if first == last else f"Pages {first}-{last}"
+
+
+def _sections_block(sections: List[tuple]) -> str:
+    # sections are (first_page, last_page, text), in chronological order
+    return "\n\n".join(
+        f"--- {_section_label(first, last)} ---\n{text}" for first, last, text in sections
+    )
+
+
+def _story_messages(prompt: str) -> List[dict]:
+    return [
+        {"role": "system", "content": "You are a story-writing assistant."},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def _complete_story_call(prompt: str, max_tokens: int) -> str:
+    response = call_with_retry(
+        openai.chat.completions.create,
         model="gpt-4o-mini",
-        messages=[
-            {"role": "system", "content": "You are a story-writing assistant."},
-            {"role": "user", "content": aggregate_prompt},
-        ],
+        messages=_story_messages(prompt),
         temperature=0.7,
-        max_tokens=1200,
+        max_tokens=max_tokens,
     )
+    return response.choices[0].message.content.strip()
 
 
-    return response.choices[0].message.content.strip()
-    
+def iter_completion_text(messages: List[dict], model: str = "gpt-4o-mini", **kwargs) -> Iterator[str]:
+    """
+    Streams a chat completion (stream=True) and yields the text deltas as they arrive.
+    Opening the stream goes through call_with_retry; an error mid-stream is raised as is.
+    """
+    stream = call_with_retry(
+        openai.chat.completions.create, model=model, messages=messages, stream=True, **kwargs
+    )
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+
+def estimate_sections_tokens(sections: List[tuple]) -> int:
+    # ~4 characters per token, as for the narration batches
+    return len(_sections_block(sections)) // 4
+
+
+def synopsis_key(sections: List[tuple], max_tokens: int, prompt_version: str = SYNOPSIS_PROMPT_VERSION) -> str:
+    """
+    Cache key of a chapter synopsis: a hash of its input sections, so the same pages (whatever
+    the story style) reuse it.
+    """
+    digest = hashlib.sha256(f"synopsis\0{prompt_version}\0{max_tokens}".encode("utf-8"))
+    for first, last, text in sections:
+        digest.update(f"\0{first}-{last}\0{text}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+def summarize_chapter(sections: List[tuple], max_tokens: int = 500, cache: Optional[NarrationCache] = None) -> tuple:
+    """
+    Condense consecutive sections (page narrations or earlier synopses) into one chapter synopsis,
+    reusing the one stored in cache (the narration cache) for the same sections.
+    Returns (first_page, last_page, synopsis).
+    """
+    key = synopsis_key(sections, max_tokens) if cache is not None else None
+    synopsis = cache.get(key) if cache is not None else None
+    if synopsis is None:
+        prompt = "\n\n".join([
+            "Here are narrations of consecutive parts of a comic, in chronological order:",
+            _sections_block(sections),
+            "Write a factual chapter synopsis (about 150-250 words) covering these parts in order. "
+            "Keep every plot event, character name and important detail; do not add a style or commentary.",
+        ])
+        synopsis = _complete_story_call(prompt, max_tokens)
+        if cache is not None:
+            cache.put(key, synopsis)
+    return sections[0][0], sections[-1][1], synopsis
+
+
+def _split_evenly(sections: List[tuple], fan_in: int) -> List[List[tuple]]:
+    # ceil(n / fan_in) consecutive groups whose sizes differ by at most one, each of at least
+    # two sections, so every synopsis covers a similar share of the comic
+    n_groups = max(1, min(max(2, math.ceil(len(sections) / fan_in)), len(sections) // 2))
+    size, extra = divmod(len(sections), n_groups)
+    groups, start = [], 0
+    for i in range(n_groups):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(sections[start:end])
+        start = end
+    return groups
+
+
+def reduce_to_sections(
+    page_summaries: List[str],
+    fan_in: int = AGGREGATION_FAN_IN,
+    max_workers: int = 4,
+    max_prompt_tokens: int = AGGREGATION_MAX_PROMPT_TOKENS,
+    cache: Optional[NarrationCache] = None
+) -> List[tuple]:
+    """
+    Page narrations as (first_page, last_page, text) sections for the final story prompt.
+    They are passed through as is while their estimated tokens fit in max_prompt_tokens; beyond
+    that (long graphic novels) they are tree-reduced: each level is split into near-equal groups of
+    at most fan_in sections, summarized into chapter synopses in parallel, until the sections fit.
+    The number of sequential calls grows with log(pages), and synopses are cached by their input
+    (see summarize_chapter), so re-running the story in another style makes no synopsis calls.
+    """
+    if fan_in < 2:
+        raise ValueError("fan_in must be at least 2.")
+    sections = [(i, i, text) for i, text in enumerate(page_summaries, start=1)]
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while len(sections) > 1 and estimate_sections_tokens(sections) > max_prompt_tokens:
+            groups = _split_evenly(sections, fan_in)
+            sections = list(pool.map(lambda group: summarize_chapter(group, cache=cache), groups))
+    return sections
+
+
+def _final_story_prompt(sections: List[tuple], style: str = None) -> str:
+    return "\n\n".join([
+        "I have a comic that spans several pages. For each part, I already have a detailed "
+        "narration of what is happening (in chronological order). Here are the narrations:",
+        _sections_block(sections),
+        "Please combine and rewrite all of these descriptions into a single, coherent short story. "
+        + STYLE_INSTRUCTIONS.get(style, "Keep a neutral, straightforward tone. ")
+        + "Keep it concise (about 300–400 words), maintain narrative flow, and preserve character names or details.",
+    ])
+
+
+def aggregate_story(
+    page_summaries: List[str],
+    style: str = None,
+    fan_in: int = AGGREGATION_FAN_IN,
+    max_workers: int = 4,
+    cache: Optional[NarrationCache] = None
+) -> str:
+    """
+    Combines page narrations into the final 300-400 word story (see reduce_to_sections).
+    """
+    sections = reduce_to_sections(page_summaries, fan_in, max_workers, cache=cache)
+    return _complete_story_call(_final_story_prompt(sections, style), max_tokens=1200)
+
+
+# Progress events from iter_process_entire_comic; data depends on kind:
+#   "page"        {"page": 1-based page number, "cached": bool}   page rendered + OCR'd
+#   "batch"       {"batch": k, "submitted": n, "pages": [...]}    k-th finished narration batch, of n submitted so far
+#   "narrations"  [page narration, ...]                           all page narrations, in order
+#   "aggregating" {"pages": n, "sections": m}                     final story call is starting
+#   "token"       str                                             a chunk of the final story
+StoryEvent = namedtuple("StoryEvent", ["kind", "data"])
+
+
+def iter_process_entire_comic(
+    pdf_path: str,
+    temp_folder: str,
+    style: str = None,
+    use_cache: bool = True,
+    quota_bytes: Optional[int] = WORKSPACE_QUOTA_BYTES,
+    debug_pages: bool = DEBUG_PAGES,
+    ocr_workers: Optional[int] = None
+) -> Iterator[StoryEvent]:
+    """
+    1. Render PDF pages to in-memory JPEGs (also written to temp_folder when debug_pages is set;
+       use a job_workspace() so concurrent jobs don't collide) and run OCR on each, on background threads.
+    2. Look up each page in the narration cache; pack the uncached pages into batches sized by
+       their estimated image and narration tokens (BatchPlanner) as they become ready, and send
+       the batches to GPT-4o concurrently for page-wise narrations, while the next pages are
+       still being rendered and OCR'd.
+    3. Read the structured (JSON) per-page narrations, re-requesting any skipped page on its own,
+       and reassemble them by absolute page index.
+    4. Combine all summaries into a cohesive short story, streaming it; only comics whose narrations
+       overflow the prompt budget are first condensed into cached chapter synopses (reduce_to_sections).
+    Yields StoryEvents as work completes, ending with the story's "token" events.
+    """
+    cache = get_narration_cache() if use_cache else None
+    narrations = {}
+    page_keys = {}
+
+    # Steps A-C: render + OCR pages in the background, dispatch uncached pages in token-budgeted batches
+    with NarrationScheduler() as scheduler:
+        futures = {}
+        planner = BatchPlanner()
+        submitted = finished = 0
+
+        def submit(batch: PlannedBatch) -> None:
+            nonlocal submitted
+            indices, batch_pages, batch_ocr = zip(*batch.items)
+            future = scheduler.submit(
+                list(indices), list(batch_pages), list(batch_ocr),
+                max_tokens=batch.max_tokens, input_tokens=batch.input_tokens
+            )
+            futures[future] = [index + 1 for index in indices]
+            submitted += 1
+
+        def batch_done(future: Future) -> StoryEvent:
+            nonlocal finished
+            batch_narrations = future.result()
+            narrations.update(batch_narrations)
+            # Cache each batch as it lands, so a failed or cancelled job keeps the pages already paid for
+            if cache is not None:
+                for index, narration in batch_narrations.items():
+                    if index in page_keys:
+                        cache.put(page_keys[index], narration)
+            finished += 1
+            return StoryEvent("batch", {"batch": finished, "submitted": submitted, "pages": futures.pop(future)})
+
+        pages = iter_ocr_pages(
+            pdf_path, temp_folder, ocr_workers=ocr_workers, quota_bytes=quota_bytes, debug_pages=debug_pages
+        )
+        for page, ocr_text in pages:
+            index = page.index
+            cached = None
+            if cache is not None:
+                key = NarrationCache.make_key(page.jpeg, ocr_text, scheduler.model, scheduler.temperature)
+                cached = cache.get(key)
+                if cached is None:
+                    page_keys[index] = key
+                else:
+                    narrations[index] = cached
+            yield StoryEvent("page", {"page": index + 1, "cached": cached is not None})
+            if cached is None:
+                batch = planner.add(
+                    (index, page, ocr_text),
+                    estimate_page_input_tokens(page, ocr_text),
+                    estimate_output_tokens(ocr_text),
+                )
+                if batch:
+                    submit(batch)
+            for future in [f for f in futures if f.done()]:
+                yield batch_done(future)
+        batch = planner.flush()
+        if batch:
+            submit(batch)
+        for future in as_completed(list(futures)):
+            yield batch_done(future)
+
+    page_summaries: List[str] = [narrations[i] for i in sorted(narrations)]
+    yield StoryEvent("narrations", page_summaries)
+
+    # Step D: Tree-reduce page_summaries, then stream the final story
+    sections = reduce_to_sections(page_summaries, cache=cache)
+    yield StoryEvent("aggregating", {"pages": len(page_summaries), "sections": len(sections)})
+    for text in iter_completion_text(
+        _story_messages(_final_story_prompt(sections, style)), temperature=0.7, max_tokens=1200
+    ):
+        yield StoryEvent("token", text)
+
+
+def process_entire_comic(
+    pdf_path: str,
+    temp_folder: str,
+    style: str = None,
+    use_cache: bool = True,
+    quota_bytes: Optional[int] = WORKSPACE_QUOTA_BYTES,
+    debug_pages: bool = DEBUG_PAGES,
+    ocr_workers: Optional[int] = None
+) -> str:
+    """
+    Runs iter_process_entire_comic to completion.
+    Returns the final combined story text.
+    """
+    events = iter_process_entire_comic(
+        pdf_path, temp_folder, style, use_cache, quota_bytes, debug_pages, ocr_workers
+    )
+    return "".join(event.data for event in events if event.kind == "token").strip()
 
 #--------------------------------------------
 # Text-to-Speech Output / AudioBook
 #--------------------------------------------
 
-import openai
-import uuid
-import os
+# The TTS endpoint rejects inputs over 4096 characters; smaller chunks also synthesize in parallel
+TTS_CHUNK_CHARS = int(os.getenv("COMICVERSE_TTS_CHUNK_CHARS", "1200"))
+TTS_MAX_WORKERS = int(os.getenv("COMICVERSE_TTS_WORKERS", "4"))
+
+# Sentence ends: latin punctuation and the Devanagari danda (Hindi translations),
+# optionally followed by a closing quote or bracket
+_SENTENCE_END = re.compile(r"(?:(?<=[.!?।])|(?<=[.!?।][\"'”’)]))\s+")
+
+
+def chunk_text_for_tts(text: str, max_chars: int = TTS_CHUNK_CHARS) -> List[str]:
+    """
+    Splits text into chunks of at most max_chars, breaking at sentence boundaries
+    (or at spaces for a single sentence longer than max_chars).
+    Paragraphs are chunked separately, so editing one paragraph leaves the other chunks
+    (and their cached audio) unchanged.
+    """
+    chunks = []
+    for paragraph in re.split(r"\n\s*\n", text.strip()):
+        chunks.extend(_pack_sentences(paragraph, max_chars))
+    return chunks
+
+
+def _pack_sentences(text: str, max_chars: int) -> List[str]:
+    chunks, current = [], ""
+    for sentence in _SENTENCE_END.split(text.strip()):
+        sentence = " ".join(sentence.split())
+        if not sentence:
+            continue
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
 
 
-def generate_speech(narration_text: str, voice: str = "alloy") -> str:
+def strip_id3(data: bytes, keep_header: bool = False) -> bytes:
     """
-    Send narration_text to OpenAI TTS (model="tts-1") 
-    save the output to an MP3 in app/static/audios/.
+    Removes ID3 tags so MP3 chunks can be concatenated frame-to-frame without re-encoding:
+    the trailing ID3v1 tag always, the leading ID3v2 tag unless keep_header is set.
+    """
+    if len(data) >= 128 and data[-128:-125] == b"TAG":
+        data = data[:-128]
+    if not keep_header and len(data) >= 10 and data[:3] == b"ID3":
+        # Tag size is a 28-bit "syncsafe" integer; a footer (flag 0x10) adds another 10 bytes
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        size += 20 if data[5] & 0x10 else 10
+        data = data[size:]
+    return data
+
+
+def synthesize_speech(text: str, voice: str = "alloy", model: str = "tts-1") -> bytes:
+    """
+    One TTS request; returns the MP3 bytes for text (at most 4096 characters).
+    """
+    response = call_with_retry(openai.audio.speech.create, model=model, voice=voice, input=text)
+    return response.content
+
+
+def _synthesize_chunk(text: str, voice: str, model: str, store: Optional["AudioStore"]) -> bytes:
+    if store is None:
+        return synthesize_speech(text, voice, model)
+    key = AudioStore.make_key(text, voice, model, kind="chunk")
+    data = store.read_chunk(key)
+    if data is None:
+        data = synthesize_speech(text, voice, model)
+        store.write_chunk(key, data)
+    return data
+
+
+def generate_speech(
+    narration_text: str,
+    voice: str = "alloy",
+    max_chars: int = TTS_CHUNK_CHARS,
+    max_workers: int = TTS_MAX_WORKERS,
+    model: str = "tts-1",
+    use_cache: bool = True,
+    on_progress: Optional[Callable[[str, int, int], None]] = None
+) -> str:
+    """
+    Send narration_text to OpenAI TTS (model="tts-1") in sentence-aligned chunks,
+    synthesized concurrently (at most max_workers at a time),
+    save the output to an MP3 in AUDIO_DIR (static/audios/).
+    Chunks are streamed in order to a "<name>.partial.mp3" file next to the book as soon as they
+    (and all earlier ones) are done; after each one, on_progress(partial_rel, chunks_done, chunks_total)
+    is called with the relative path of that file, which is a playable prefix of the book, so
+    playback can start before the rest is synthesized. The finished file is renamed into place,
+    so the cached book is never seen half-written. Point OPENAI_BASE_URL at a local fake endpoint
+    to test it offline.
+    With use_cache, the same text+voice+model returns the stored audiobook without any TTS call,
+    and only chunks not synthesized before are sent (see AudioStore).
     Returns the relative path under /static/ to the generated MP3.
     """
+    store = get_audio_store() if use_cache else None
+    if store is not None:
+        key = AudioStore.make_key(narration_text, voice, model)
+        cached = store.get(key)
+        if cached is not None:
+            return f"audios/{os.path.basename(cached)}"
+        out_path = store.book_path(key)
+    else:
+        # generate unique filename
+        out_path = os.path.join(AUDIO_DIR, f"{uuid.uuid4()}.mp3")
     # ensure output dir exists
-    out_dir = "app/static/audios"
-    os.makedirs(out_dir, exist_ok=True)
-
-    # generate unique filename
-    filename = f"{uuid.uuid4()}.mp3"
-    out_path = os.path.join(out_dir, filename)
-
-    # call OpenAI TTS
-    response = openai.audio.speech.create(
-        model="tts-1",
-        voice=voice,
-        input=narration_text
-    )
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
 
-    # write to file
-    with open(out_path, "wb") as f:
-        f.write(response.content)
+    chunks = chunk_text_for_tts(narration_text, max_chars)
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    futures = [pool.submit(_synthesize_chunk, chunk, voice, model, store) for chunk in chunks]
+    # MP3 frames are self-contained, so every in-order prefix of the book is itself playable
+    tmp_path = f"{os.path.splitext(out_path)[0]}.{uuid.uuid4().hex[:8]}.partial.mp3"
+    try:
+        with open(tmp_path, "wb") as f:
+            for i, future in enumerate(futures):
+                f.write(strip_id3(future.result(), keep_header=i == 0))
+                if on_progress is not None:
+                    f.flush()
+                    on_progress(f"audios/{os.path.basename(tmp_path)}", i + 1, len(futures))
+        os.replace(tmp_path, out_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    if store is not None:
+        store.put(key, out_path)
 
     # return path for client embedding
-    return f"audios/{filename}"
+    return f"audios/{os.path.basename(out_path)}"
+
+#--------------------------------------------
+# Audio store
+#--------------------------------------------
+
+# Streamlit serves ./static next to app.py at app/static/ (server.enableStaticServing),
+# so audiobooks written here are streamed from disk at app/static/audios/<file>
+AUDIO_DIR = os.getenv("COMICVERSE_AUDIO_DIR", os.path.join("static", "audios"))
+AUDIO_CACHE_BYTES = int(os.getenv("COMICVERSE_AUDIO_CACHE_MB", "1024")) * 1024 * 1024
+AUDIO_MAX_AGE_SECONDS = float(os.getenv("COMICVERSE_AUDIO_MAX_AGE_DAYS", "30")) * 24 * 3600
+
+
+def normalize_tts_text(text: str) -> str:
+    """
+    Unicode-normalizes text and collapses whitespace, so formatting-only edits hash the same.
+    """
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class AudioStore:
+    """
+    Content-addressed store for synthesized speech, keyed by a hash of the normalized text,
+    voice and model. Audiobooks are kept in audio_dir as <key>.mp3, so repeat requests share one
+    file; individual TTS chunks are kept under chunk_dir. Both are indexed in SQLite: entries unused
+    for max_age seconds are deleted, then least recently used ones until the files fit in max_bytes.
+    """
+    def __init__(
+        self,
+        path: str = None,
+        audio_dir: str = AUDIO_DIR,
+        chunk_dir: str = None,
+        max_bytes: int = AUDIO_CACHE_BYTES,
+        max_age: float = AUDIO_MAX_AGE_SECONDS
+    ):
+        self.path = path or os.path.join(CACHE_DIR, "audio.sqlite")
+        self.audio_dir = audio_dir
+        self.chunk_dir = chunk_dir or os.path.join(CACHE_DIR, "tts_chunks")
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        os.makedirs(self.audio_dir, exist_ok=True)
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS audio ("
+                "key TEXT PRIMARY KEY, path TEXT NOT NULL, "
+                "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def make_key(text: str, voice: str, model: str, kind: str = "book") -> str:
+        digest = hashlib.sha256(normalize_tts_text(text).encode("utf-8"))
+        for part in (voice, model, kind):
+            digest.update(b"\0" + part.encode("utf-8"))
+        return digest.hexdigest()
+
+    def book_path(self, key: str) -> str:
+        return os.path.join(self.audio_dir, f"{key}.mp3")
+
+    def chunk_path(self, key: str) -> str:
+        return os.path.join(self.chunk_dir, f"{key}.mp3")
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Returns the stored file's path, or None if the key is unknown or its file is gone.
+        """
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT path FROM audio WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if not os.path.exists(row[0]):
+                conn.execute("DELETE FROM audio WHERE key = ?", (key,))
+                conn.commit()
+                return None
+            conn.execute("UPDATE audio SET last_used = ? WHERE key = ?", (time.time(), key))
+            conn.commit()
+            return row[0]
+        finally:
+            conn.close()
+
+    def touch(self, path: str) -> bool:
+        """
+        Marks the stored file at path as just used, so it is not evicted while it is being served.
+        Returns False if the file is gone.
+        """
+        if not os.path.exists(path):
+            return False
+        conn = self._connect()
+        try:
+            conn.execute("UPDATE audio SET last_used = ? WHERE path = ?", (time.time(), path))
+            conn.commit()
+        finally:
+            conn.close()
+        return True
+
+    def put(self, key: str, path: str) -> None:
+        """
+        Records a file already written at path (book_path/chunk_path) and evicts old entries.
+        """
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO audio (key, path, size, last_used) VALUES (?, ?, ?, ?)",
+                (key, path, os.path.getsize(path), time.time()),
+            )
+            self._evict(conn, keep=key)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def read_chunk(self, key: str) -> Optional[bytes]:
+        path = self.get(key)
+        if path is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def write_chunk(self, key: str, data: bytes) -> None:
+        path = self.chunk_path(key)
+        # Write then rename, so a concurrent reader never sees a partial chunk
+        tmp_path = f"{path}.{uuid.uuid4().hex}.part"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self.put(key, path)
+
+    def _evict(self, conn: sqlite3.Connection, keep: str) -> None:
+        # Oldest first: expired entries, then whatever is needed to get under max_bytes
+        cutoff = time.time() - self.max_age
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM audio").fetchone()[0]
+        rows = conn.execute(
+            "SELECT key, path, size, last_used FROM audio WHERE key != ? ORDER BY last_used", (keep,)
+        ).fetchall()
+        stale = []
+        for key, path, size, last_used in rows:
+            if last_used >= cutoff and total <= self.max_bytes:
+                break
+            stale.append((key,))
+            total -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        conn.executemany("DELETE FROM audio WHERE key = ?", stale)
+
+
+_audio_store = None
+
+
+def get_audio_store() -> AudioStore:
+    """
+    Returns the process-wide audio store, creating it on first use.
+    """
+    global _audio_store
+    if _audio_store is None:
+        _audio_store = AudioStore()
+    return _audio_store
+
+
+def touch_audiobook(audio_rel: str) -> bool:
+    """
+    Called whenever an audiobook ("audios/<file>.mp3", as returned by generate_speech) is shown
+    to someone: bumps its last use so eviction keeps the books people are listening to.
+    Returns False if the file has already been evicted.
+    """
+    return get_audio_store().touch(os.path.join(AUDIO_DIR, os.path.basename(audio_rel)))
 
 #--------------------------------------------
 # Translate to Hindi option
 #--------------------------------------------
+
+def _translation_messages(text: str, target_lang: str) -> List[dict]:
+    prompt = f"Translate the following story to {target_lang.upper()}:\n\n{text}"
+    return [{"role": "user", "content": prompt}]
+
+
 def translate_text(text: str, target_lang: str = "hi") -> str:
     """
     Translates text to target_lang using OpenAI or another service.
     Currently uses OpenAI's `gpt-4` for simplicity.
     """
-    prompt = f"Translate the following story to {target_lang.upper()}:\n\n{text}"
-    response = openai.chat.completions.create(
+    response = call_with_retry(
+        openai.chat.completions.create,
         model="gpt-4o-mini",
-        messages=[{"role": "user", "content": prompt}]
+        messages=_translation_messages(text, target_lang)
     )
     return response.choices[0].message.content.strip()
+
+
+def iter_translate_text(text: str, target_lang: str = "hi") -> Iterator[str]:
+    """
+    Streaming translate_text: yields the translation in chunks as the model writes it.
+    """
+    return iter_completion_text(_translation_messages(text, target_lang))
+
+#--------------------------------------------
+# Batch CLI: python -m comicToStory_audio_batching
+#--------------------------------------------
+
+def iter_input_pdfs(inputs: List[str], manifest: Optional[str] = None, recursive: bool = False) -> Iterator[str]:
+    """
+    Yields PDF paths from the given files and directories (sorted; subdirectories too if recursive)
+    and from a manifest file with one path per line (relative to the manifest; blank lines and
+    # comments skipped).
+    """
+    paths = list(inputs)
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    paths.append(os.path.join(base, line))
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.lower().endswith(".pdf"):
+                    yield os.path.join(root, name)
+            if not recursive:
+                break
+
+
+def comic_job_key(pdf_path: str, style: str, language: str, audio: bool) -> str:
+    """
+    Identifies one comic run: the file (absolute path, size, mtime) and the output options.
+    """
+    stat = os.stat(pdf_path)
+    ident = [os.path.abspath(pdf_path), stat.st_size, stat.st_mtime_ns, style, language, audio]
+    return hashlib.sha256(json.dumps(ident).encode("utf-8")).hexdigest()
+
+
+def load_checkpoint(path: str) -> set:
+    """
+    Returns the keys of comics already completed in a results JSONL file.
+    A truncated last line (crash mid-write) is ignored.
+    """
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("status") == "ok":
+                done.add(record["key"])
+    return done
+
+
+def process_comic_file(
+    pdf_path: str,
+    style: str = None,
+    language: str = "English",
+    audio: bool = False,
+    voice: str = "alloy",
+    use_cache: bool = True,
+    ocr_workers: Optional[int] = None
+) -> dict:
+    """
+    Story (and optionally translation and audiobook) for one PDF, with per-stage timings in seconds.
+    """
+    timings = {}
+    started = mark = time.perf_counter()
+
+    def lap(stage: str) -> None:
+        nonlocal mark
+        now = time.perf_counter()
+        timings[stage] = round(now - mark, 3)
+        mark = now
+
+    pages = 0
+    story = ""
+    with job_workspace() as workspace:
+        events = iter_process_entire_comic(
+            pdf_path, workspace, style=style, use_cache=use_cache, ocr_workers=ocr_workers
+        )
+        for event in events:
+            if event.kind == "token":
+                story += event.data
+            elif event.kind == "narrations":
+                pages = len(event.data)
+                lap("narration")
+    story = story.strip()
+    lap("story")
+    if language.lower() == "hindi":
+        story = translate_text(story, target_lang="hi")
+        lap("translation")
+    audio_path = None
+    if audio:
+        audio_path = os.path.join(AUDIO_DIR, os.path.basename(generate_speech(story, voice=voice)))
+        lap("audio")
+    timings["total"] = round(time.perf_counter() - started, 3)
+    return {"pages": pages, "story": story, "audio_path": audio_path, "timings": timings}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m comicToStory_audio_batching",
+        description="Turn comic PDFs into stories (and audiobooks), checkpointing each comic to a JSONL "
+                    "file so an interrupted run resumes where it stopped.",
+    )
+    parser.add_argument("inputs", nargs="*", help="PDF files and/or directories of PDFs")
+    parser.add_argument("--manifest", help="text file listing one PDF path per line")
+    parser.add_argument("--recursive", action="store_true", help="also search subdirectories")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="results / checkpoint file")
+    parser.add_argument("-w", "--workers", type=int, default=2, help="comics processed concurrently")
+    parser.add_argument("--style", choices=["Neutral", "Dramatic", "Fun"], default="Neutral")
+    parser.add_argument("--language", choices=["English", "Hindi"], default="English")
+    parser.add_argument("--audio", action="store_true", help="also generate an audiobook per comic")
+    parser.add_argument("--voice", default="alloy")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the page narration cache")
+    args = parser.parse_args(argv)
+    if not args.inputs and not args.manifest:
+        parser.error("give at least one PDF or directory, or --manifest")
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    done = load_checkpoint(args.output)
+    # Each comic OCRs on its own process pool; split the cores between the concurrent comics
+    ocr_workers = max(1, (os.cpu_count() or 1) // args.workers)
+    counts = {"ok": 0, "error": 0, "skipped": 0}
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool, open(args.output, "a", encoding="utf-8") as out:
+        pending = {}
+
+        def write_finished(futures) -> None:
+            for future in futures:
+                pdf_path, key = pending.pop(future)
+                record = {"pdf": pdf_path, "key": key}
+                try:
+                    record.update(status="ok", **future.result())
+                except Exception as e:
+                    record.update(status="error", error=f"{type(e).__name__}: {e}")
+                record["finished_at"] = time.strftime("%Y-%m-%dT%H:%M:%S")
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+                os.fsync(out.fileno())
+                counts[record["status"]] += 1
+                print(f"[{record['status']}] {pdf_path}", file=sys.stderr)
+
+        for pdf_path in iter_input_pdfs(args.inputs, args.manifest, args.recursive):
+            try:
+                key = comic_job_key(pdf_path, args.style, args.language, args.audio)
+            except OSError as e:
+                print(f"[error] {pdf_path}: {e}", file=sys.stderr)
+                counts["error"] += 1
+                continue
+            if key in done:
+                counts["skipped"] += 1
+                continue
+            done.add(key)
+            # Keep only a couple of comics queued per worker, however many PDFs are listed
+            while len(pending) >= 2 * args.workers:
+                write_finished(wait(pending, return_when=FIRST_COMPLETED).done)
+            future = pool.submit(
+                process_comic_file, pdf_path, args.style, args.language, args.audio,
+                args.voice, not args.no_cache, ocr_workers,
+            )
+            pending[future] = (pdf_path, key)
+        while pending:
+            write_finished(wait(pending, return_when=FIRST_COMPLETED).done)
+
+    print(
+        f"{counts['ok']} done, {counts['error']} failed, {counts['skipped']} already done "
+        f"(results in {args.output})",
+        file=sys.stderr,
+    )
+    return 1 if counts["error"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,570 @@
+"""
+Infrastructure shared by the app pipeline (comicToStory_audio_batching.py) and the
+evaluation suite (eval/): per-job workspaces, the OpenAI retry layer and rate limiter,
+token-budgeted batch planning and the OCR result cache. Both import it, so they share one
+circuit breaker, one rate limit, one set of retry counters and one OCR cache.
+"""
+import hashlib
+import importlib
+import io
+import math
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from typing import Iterator, List, Optional
+
+from PIL import Image
+
+#--------------------------------------------
+# Per-job workspaces
+#--------------------------------------------
+
+class WorkspaceQuotaExceeded(OSError):
+    """Raised when a job writes more into its workspace than its disk quota allows."""
+
+
+def workspace_usage(path: str) -> int:
+    """
+    Returns the total size in bytes of the files under path.
+    """
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, files in os.walk(path)
+        for name in files
+    )
+
+
+def check_workspace_quota(path: str, quota_bytes: Optional[int]) -> None:
+    if quota_bytes is None:
+        return
+    used = workspace_usage(path)
+    if used > quota_bytes:
+        raise WorkspaceQuotaExceeded(
+            f"Workspace {path} uses {used} bytes, over its quota of {quota_bytes} bytes."
+        )
+
+
+@contextmanager
+def job_workspace(use_tmpfs: Optional[bool] = None, prefix: str = "comicverse_") -> Iterator[str]:
+    """
+    Creates a private scratch directory for one job and deletes it when the job is done,
+    so concurrent jobs never share page_XXX files. With use_tmpfs (or COMICVERSE_USE_TMPFS=1)
+    the directory is created in /dev/shm when available; otherwise under COMICVERSE_WORKSPACE_DIR
+    or the system temp dir.
+    """
+    if use_tmpfs is None:
+        use_tmpfs = os.getenv("COMICVERSE_USE_TMPFS") == "1"
+    root = os.getenv("COMICVERSE_WORKSPACE_DIR")
+    if use_tmpfs and os.path.isdir("/dev/shm"):
+        root = "/dev/shm"
+    path = tempfile.mkdtemp(prefix=prefix, dir=root)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+#--------------------------------------------
+# API retries
+#--------------------------------------------
+
+class _LazyModule:
+    """
+    Stands in for a module that is slow to import (openai loads hundreds of submodules):
+    the real import happens on first attribute access, after which `configure` runs on it once.
+    """
+    def __init__(self, name: str, configure=None):
+        self._name = name
+        self._configure = configure
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                module = importlib.import_module(self._name)
+                if self._configure is not None:
+                    self._configure(module)
+                self._module = module
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
+
+
+def _disable_sdk_retries(module) -> None:
+    # Retries are handled by call_with_retry below, not stacked on top of the SDK's own
+    module.max_retries = 0
+
+
+openai = _LazyModule("openai", configure=_disable_sdk_retries)
+
+
+@lru_cache(maxsize=1)
+def retryable_errors() -> tuple:
+    # Errors worth retrying: rate limits, timeouts, dropped connections and 5xx responses
+    return (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+
+# Counters for every call that goes through the retry layer
+RETRY_STATS = {"calls": 0, "retries": 0, "failures": 0, "rejected": 0, "backoff_seconds": 0.0}
+_stats_lock = threading.Lock()
+
+
+def record_retry_stats(**increments) -> None:
+    with _stats_lock:
+        for key, value in increments.items():
+            RETRY_STATS[key] += value
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling the API while the circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive calls have exhausted their retries and rejects new
+    calls for `cooldown` seconds. It is then half-open: one trial call is let through while the
+    others are still rejected; its success closes the breaker and its failure opens it again.
+    A trial that never reports back (e.g. it raised a non-retryable error) is replaced by
+    another after `cooldown` seconds.
+    """
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started = None
+        self._lock = threading.Lock()
+
+    def check(self) -> None:
+        with self._lock:
+            if self.opened_at is None:
+                return
+            now = time.monotonic()
+            if now - self.opened_at < self.cooldown or (
+                self.trial_started is not None and now - self.trial_started < self.cooldown
+            ):
+                raise CircuitOpenError("Too many consecutive API failures; not calling the API for now.")
+            self.trial_started = now
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_started = None
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.monotonic()
+                self.trial_started = None
+
+
+api_breaker = CircuitBreaker()
+
+# The account's OpenAI limits. Every API call in the process draws from one RateLimiter, and the
+# job server splits these between itself and its worker processes (see job_queue.WorkerPool)
+REQUESTS_PER_MINUTE = float(os.getenv("COMICVERSE_REQUESTS_PER_MINUTE", "500"))
+TOKENS_PER_MINUTE = float(os.getenv("COMICVERSE_TOKENS_PER_MINUTE", "200000"))
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that refills continuously at `per_minute` tokens per minute.
+    reserve() takes the tokens at once, going into debt if the bucket is short, and returns how
+    many seconds the caller must wait before using them: callers are served in arrival order and
+    nobody holds the lock while waiting, so threads and asyncio tasks can share one bucket.
+    """
+    def __init__(self, per_minute: float, capacity: float = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float = 1) -> float:
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimiter:
+    """
+    Requests/min and tokens/min buckets shared by call_with_retry and every NarrationScheduler
+    in the process, so concurrent jobs, threads and retries all stay under one budget.
+    Blocking callers use acquire(); async callers sleep for the delay reserve() returns.
+    """
+    def __init__(self, requests_per_minute: float = REQUESTS_PER_MINUTE, tokens_per_minute: float = TOKENS_PER_MINUTE):
+        self.configure(requests_per_minute, tokens_per_minute)
+
+    def configure(self, requests_per_minute: float, tokens_per_minute: float) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+
+    def reserve(self, tokens: int) -> float:
+        return max(self.requests.reserve(1), self.tokens.reserve(tokens))
+
+    def acquire(self, tokens: int) -> None:
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+
+api_limiter = RateLimiter()
+
+
+def estimate_request_tokens(messages: List[dict], max_tokens: int = 0, text_input=None) -> int:
+    """
+    Rough token budget of one request: ~4 characters per text token, a flat cost per image,
+    the completion (max_tokens), and the text of TTS / embeddings inputs.
+    """
+    tokens = max_tokens
+    for message in messages:
+        content = message["content"]
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        for part in parts:
+            tokens += 765 if part["type"] == "image_url" else len(part["text"]) // 4
+    if text_input:
+        texts = [text_input] if isinstance(text_input, str) else text_input
+        tokens += sum(len(text) for text in texts) // 4
+    return tokens
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    Returns the delay the server asked for via Retry-After / retry-after-ms, if any.
+    """
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    headers = response.headers
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    """
+    Exponential backoff with full jitter, so concurrent workers don't retry in lockstep.
+    """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def call_with_retry(fn, *args, max_attempts: int = 6, deadline: float = 180.0, **kwargs):
+    """
+    Calls an OpenAI SDK method (chat, TTS, ...) with jittered exponential backoff.
+    Every attempt first waits for its share of the shared rate limit (api_limiter).
+    Honours Retry-After, gives up after max_attempts or once `deadline` seconds have passed,
+    and passes the remaining time as the request timeout. Raises CircuitOpenError while
+    the shared circuit breaker is open.
+    """
+    try:
+        api_breaker.check()
+    except CircuitOpenError:
+        record_retry_stats(rejected=1)
+        raise
+    record_retry_stats(calls=1)
+    tokens = estimate_request_tokens(kwargs.get("messages", []), kwargs.get("max_tokens") or 0, kwargs.get("input"))
+    start = time.monotonic()
+    for attempt in range(max_attempts):
+        api_limiter.acquire(tokens)
+        remaining = max(1.0, deadline - (time.monotonic() - start))
+        try:
+            result = fn(*args, timeout=remaining, **kwargs)
+        except retryable_errors() as e:
+            delay = retry_after_seconds(e)
+            if delay is None:
+                delay = backoff_delay(attempt)
+            if attempt + 1 == max_attempts or time.monotonic() - start + delay >= deadline:
+                api_breaker.record_failure()
+                record_retry_stats(failures=1)
+                raise
+            record_retry_stats(retries=1, backoff_seconds=delay)
+            time.sleep(delay)
+            continue
+        api_breaker.record_success()
+        return result
+
+
+def get_retry_stats() -> dict:
+    """
+    Returns a snapshot of the retry counters, including total seconds spent backing off.
+    """
+    with _stats_lock:
+        return dict(RETRY_STATS)
+
+#--------------------------------------------
+# Batch planning
+#--------------------------------------------
+
+# Hard ceiling on pages per request, whatever the token budget allows
+MAX_PAGES_PER_BATCH = 10
+
+
+def estimate_image_tokens(width: int, height: int, detail: str = "high") -> int:
+    """
+    Estimates the input tokens for one image using GPT-4o's tiling rule: fit into 2048x2048,
+    scale the short side down to 768, then 170 tokens per 512px tile plus 85.
+    """
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+def estimate_output_tokens(ocr_text: str, base: int = 120, cap: int = 500) -> int:
+    """
+    Estimates the narration length for one page: a base for the artwork plus roughly
+    one token per OCR token (~4 characters), so dense dialogue pages get more room.
+    """
+    return min(cap, base + len(ocr_text.strip()) // 4)
+
+
+PlannedBatch = namedtuple("PlannedBatch", ["items", "input_tokens", "max_tokens"])
+
+
+class BatchPlanner:
+    """
+    Greedily packs pages, in order, into batches whose estimated input tokens and
+    expected output tokens stay under budget. add() returns a finished PlannedBatch
+    whenever the next page would not fit; call flush() after the last page.
+    max_tokens for each batch is scaled to its expected output.
+    """
+    def __init__(
+        self,
+        max_input_tokens: int = 6000,
+        max_output_tokens: int = 2400,
+        max_pages: int = MAX_PAGES_PER_BATCH
+    ):
+        self.max_input_tokens = max_input_tokens
+        self.max_output_tokens = max_output_tokens
+        self.max_pages = max_pages
+        self._items = []
+        self._input = 0
+        self._output = 0
+
+    def add(self, item, input_tokens: int, output_tokens: int) -> Optional[PlannedBatch]:
+        finished = None
+        if self._items and (
+            len(self._items) >= self.max_pages
+            or self._input + input_tokens > self.max_input_tokens
+            or self._output + output_tokens > self.max_output_tokens
+        ):
+            finished = self.flush()
+        self._items.append(item)
+        self._input += input_tokens
+        self._output += output_tokens
+        return finished
+
+    def flush(self) -> Optional[PlannedBatch]:
+        if not self._items:
+            return None
+        # Leave headroom over the estimate so narrations are not cut off
+        max_tokens = min(self.max_output_tokens, int(self._output * 1.2) + 50)
+        batch = PlannedBatch(self._items, self._input, max_tokens)
+        self._items, self._input, self._output = [], 0, 0
+        return batch
+
+
+def plan_batches(
+    input_tokens: List[int],
+    output_tokens: List[int],
+    max_input_tokens: int = 6000,
+    max_output_tokens: int = 2400,
+    max_pages: int = MAX_PAGES_PER_BATCH
+) -> List[PlannedBatch]:
+    """
+    Packs pages 0..n-1 into consecutive batches under the token budget.
+    Each PlannedBatch.items holds the page indices of one batch.
+    """
+    planner = BatchPlanner(max_input_tokens, max_output_tokens, max_pages)
+    batches = []
+    for index, (tokens_in, tokens_out) in enumerate(zip(input_tokens, output_tokens)):
+        batch = planner.add(index, tokens_in, tokens_out)
+        if batch:
+            batches.append(batch)
+    batch = planner.flush()
+    if batch:
+        batches.append(batch)
+    return batches
+
+#--------------------------------------------
+# OCR helpers and result cache
+#--------------------------------------------
+
+# Directory for the on-disk caches (OCR, narrations, jobs, embeddings)
+CACHE_DIR = os.getenv("COMICVERSE_CACHE_DIR", ".cache")
+
+
+def get_pytesseract():
+    # pytesseract is slow to import, so it is only loaded on the first OCR call.
+    # Tesseract executable path: TESSERACT_CMD (e.g. C:\Program Files\Tesseract-OCR\tesseract.exe); unset to use PATH
+    import pytesseract
+    tesseract_cmd = os.getenv("TESSERACT_CMD")
+    if tesseract_cmd:
+        pytesseract.pytesseract.tesseract_cmd = tesseract_cmd
+    return pytesseract
+
+
+def init_ocr_worker(tesseract_threads: int) -> None:
+    # Tesseract uses OpenMP internally; cap it so N workers don't oversubscribe the cores
+    os.environ["OMP_THREAD_LIMIT"] = str(tesseract_threads)
+
+
+@lru_cache(maxsize=1)
+def tesseract_version() -> str:
+    return str(get_pytesseract().get_tesseract_version())
+
+
+def difference_hash(image_bytes: bytes) -> int:
+    """
+    64-bit perceptual difference hash (dHash): robust to rescaling and recompression.
+    """
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        small = img.convert("L").resize((9, 8), Image.LANCZOS)
+    pixels = list(small.getdata())
+    bits = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+
+class OCRCache:
+    """
+    SQLite cache of tesseract output keyed by the image digest, DPI, language and tesseract version.
+    With perceptual=True, a miss on the exact digest falls back to the closest stored page whose
+    64-bit difference hash is within max_distance bits, so the same page re-rendered at a
+    slightly different scale or JPEG quality still hits. Hit/miss counts are kept in `stats`.
+    """
+    def __init__(self, path: str = None, perceptual: bool = False, max_distance: int = 4):
+        self.path = path or os.path.join(CACHE_DIR, "ocr.sqlite")
+        self.perceptual = perceptual
+        self.max_distance = max_distance
+        self.stats = {"hits": 0, "perceptual_hits": 0, "misses": 0}
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS ocr ("
+                "key TEXT PRIMARY KEY, phash TEXT NOT NULL, lang TEXT NOT NULL, "
+                "version TEXT NOT NULL, text TEXT NOT NULL)"
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    @staticmethod
+    def _key(image_bytes: bytes, dpi, lang: str, version: str) -> str:
+        digest = hashlib.sha256(image_bytes)
+        digest.update(f"\0{dpi}\0{lang}\0{version}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _count(self, stat: str) -> None:
+        with self._lock:
+            self.stats[stat] += 1
+
+    def get(self, image_bytes: bytes, dpi=None, lang: str = "eng") -> Optional[str]:
+        version = tesseract_version()
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT text FROM ocr WHERE key = ?", (self._key(image_bytes, dpi, lang, version),)
+            ).fetchone()
+            if row is not None:
+                self._count("hits")
+                return row[0]
+            if self.perceptual:
+                target = difference_hash(image_bytes)
+                best = None
+                for phash, text in conn.execute(
+                    "SELECT phash, text FROM ocr WHERE lang = ? AND version = ?", (lang, version)
+                ):
+                    distance = bin(target ^ int(phash, 16)).count("1")
+                    if distance <= self.max_distance and (best is None or distance < best[0]):
+                        best = (distance, text)
+                if best is not None:
+                    self._count("perceptual_hits")
+                    return best[1]
+        finally:
+            conn.close()
+        self._count("misses")
+        return None
+
+    def put(self, image_bytes: bytes, text: str, dpi=None, lang: str = "eng") -> None:
+        version = tesseract_version()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO ocr (key, phash, lang, version, text) VALUES (?, ?, ?, ?, ?)",
+                (
+                    self._key(image_bytes, dpi, lang, version),
+                    f"{difference_hash(image_bytes):016x}",
+                    lang,
+                    version,
+                    text,
+                ),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def hit_rate(self) -> float:
+        with self._lock:
+            hits = self.stats["hits"] + self.stats["perceptual_hits"]
+            total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+
+_ocr_cache = None
+
+
+def get_ocr_cache() -> OCRCache:
+    """
+    Returns the process-wide OCR cache, creating it on first use.
+    Set COMICVERSE_OCR_PERCEPTUAL=1 to enable perceptual-hash lookups.
+    """
+    global _ocr_cache
+    if _ocr_cache is None:
+        _ocr_cache = OCRCache(perceptual=os.getenv("COMICVERSE_OCR_PERCEPTUAL") == "1")
+    return _ocr_cache
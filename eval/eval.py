@@ -1,39 +1,190 @@
 import pandas as pd
 import numpy as np
-import textstat
-from bert_score import score
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
+import hashlib
+import json
+import os
+from functools import lru_cache
+from typing import List, Optional
 
 use_ground_truth = True
 
 # API to compute readability scores
 def compute_readability(text):
+    import textstat
     return {
         "flesch_reading_ease": textstat.flesch_reading_ease(text),
         "flesch_kincaid_grade": textstat.flesch_kincaid_grade(text)
     }
 
+# Pairs per BERTScorer.score call; within a call bert_score embeds in batches of BERTSCORE_BATCH_SIZE
+BERTSCORE_CHUNK_SIZE = 256
+BERTSCORE_BATCH_SIZE = 64
+
+
+# One scorer (and model) for the whole run instead of one per pair
+@lru_cache(maxsize=None)
+def get_bert_scorer() -> "BERTScorer":
+    # bert_score (and torch behind it) is only imported once something is actually scored
+    from bert_score import BERTScorer
+    return BERTScorer(lang="en", batch_size=BERTSCORE_BATCH_SIZE)
+
+
+# API to calculate BERTScore for many (candidate, reference) pairs at once
+def compute_bertscore_batch(candidates: List[str], references: List[str]) -> List[dict]:
+    """
+    Scores all pairs in a few padded batches: pairs are sorted by length so each chunk
+    holds texts of similar size, then the scores are put back in input order.
+    """
+    if len(candidates) != len(references):
+        raise ValueError("candidates and references must have the same length.")
+    if not candidates:
+        # Nothing to score: don't load the model
+        return []
+    scorer = get_bert_scorer()
+    order = sorted(range(len(candidates)), key=lambda i: len(candidates[i]) + len(references[i]))
+    results: List[Optional[dict]] = [None] * len(candidates)
+    for start in range(0, len(order), BERTSCORE_CHUNK_SIZE):
+        chunk = order[start:start + BERTSCORE_CHUNK_SIZE]
+        P, R, F1 = scorer.score([candidates[i] for i in chunk], [references[i] for i in chunk], verbose=False)
+        for k, i in enumerate(chunk):
+            results[i] = {"precision": float(P[k]), "recall": float(R[k]), "f1": float(F1[k])}
+    return results
+
+
 # API to calulate the BERTScore
 def compute_bertscore(candidate, reference):
-    
-    P, R, F1 = score([candidate], [reference], lang="en", verbose=False)
-    return {
-        "precision": float(P[0]),
-        "recall": float(R[0]),
-        "f1": float(F1[0])
-    }
+    return compute_bertscore_batch([candidate], [reference])[0]
+
+
+# API to compute the BERTScores get_eval_data needs for every PDF of a run, in one batched pass
+def compute_run_bertscores(runs: List[tuple]) -> List[tuple]:
+    """
+    runs holds (story_image, story_ocr, story_ocr_image) per PDF. Returns, per PDF,
+    (ocr vs image, ocr+image vs image) BERTScores to pass to get_eval_data(bertscores=...).
+    """
+    candidates, references = [], []
+    for story_image, story_ocr, story_ocr_image in runs:
+        candidates += [story_ocr, story_ocr_image]
+        references += [story_image, story_image]
+    scores = compute_bertscore_batch(candidates, references)
+    return [tuple(scores[i:i + 2]) for i in range(0, len(scores), 2)]
+
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+EMBEDDING_CACHE_DIR = os.path.join(os.getenv("COMICVERSE_CACHE_DIR", ".cache"), "embeddings")
+
+
+# Loaded on first use, once per run
+@lru_cache(maxsize=None)
+def get_sentence_model(model_name: str = EMBEDDING_MODEL) -> "SentenceTransformer":
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of normalized sentence embeddings for one model: a memory-mapped float32
+    matrix (one row per text) plus a JSON index from sha256(model, text) to row.
+    Missing texts are encoded together in one batch. Meant for a single writer process.
+    """
+    def __init__(self, model_name: str = EMBEDDING_MODEL, cache_dir: str = EMBEDDING_CACHE_DIR):
+        self.model_name = model_name
+        self.dir = os.path.join(cache_dir, model_name.replace("/", "__"))
+        self.matrix_path = os.path.join(self.dir, "vectors.f32")
+        self.index_path = os.path.join(self.dir, "index.json")
+        os.makedirs(self.dir, exist_ok=True)
+        self.index = {}
+        self.dim = None
+        if os.path.exists(self.index_path):
+            with open(self.index_path, encoding="utf-8") as f:
+                saved = json.load(f)
+            self.index, self.dim = saved["rows"], saved["dim"]
+        self._matrix = None
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\0{text}".encode("utf-8")).hexdigest()
+
+    def _open(self, rows: int) -> np.memmap:
+        # Grow the backing file (doubling) so appends don't rewrite the matrix every time
+        capacity = os.path.getsize(self.matrix_path) // (4 * self.dim) if os.path.exists(self.matrix_path) else 0
+        if capacity < rows:
+            capacity = max(rows, 2 * capacity, 1024)
+            self._matrix = None
+            with open(self.matrix_path, "ab") as f:
+                f.truncate(capacity * self.dim * 4)
+        if self._matrix is None or len(self._matrix) < rows:
+            self._matrix = np.memmap(self.matrix_path, dtype=np.float32, mode="r+", shape=(capacity, self.dim))
+        return self._matrix
+
+    def encode(self, texts: List[str], batch_size: int = 64) -> np.ndarray:
+        """
+        Returns a (len(texts), dim) float32 array of unit-length embeddings,
+        encoding only the distinct texts not cached yet.
+        """
+        keys = [self.key(text) for text in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self.index:
+                missing.setdefault(key, text)
+        if missing:
+            vectors = get_sentence_model(self.model_name).encode(
+                list(missing.values()), batch_size=batch_size, convert_to_numpy=True, normalize_embeddings=True
+            ).astype(np.float32)
+            self.dim = self.dim or vectors.shape[1]
+            start = len(self.index)
+            matrix = self._open(start + len(vectors))
+            matrix[start:start + len(vectors)] = vectors
+            matrix.flush()
+            for row, key in enumerate(missing, start=start):
+                self.index[key] = row
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"dim": self.dim, "rows": self.index}, f)
+            os.replace(tmp_path, self.index_path)
+        if not texts:
+            return np.zeros((0, self.dim or 0), dtype=np.float32)
+        matrix = self._open(len(self.index))
+        return np.asarray(matrix[[self.index[key] for key in keys]])
+
+
+@lru_cache(maxsize=None)
+def get_embedding_cache(model_name: str = EMBEDDING_MODEL) -> EmbeddingCache:
+    return EmbeddingCache(model_name)
+
+
+# API to compute cosine similarities for many text pairs with one matrix product
+def compute_similarities(pairs: List[tuple]) -> np.ndarray:
+    """
+    Each distinct text is embedded once (cached on disk); since embeddings are unit length,
+    all cosine similarities come from a single E @ E.T over the distinct texts.
+    """
+    texts = list(dict.fromkeys(text for pair in pairs for text in pair))
+    position = {text: i for i, text in enumerate(texts)}
+    embeddings = get_embedding_cache().encode(texts)
+    sims = embeddings @ embeddings.T
+    return np.array([sims[position[a], position[b]] for a, b in pairs], dtype=float)
+
 
 # API to compute Cosine similarity using sentence-transformers
-model = SentenceTransformer('all-MiniLM-L6-v2')
 def compute_cosine_similarity(text1, text2):
-    emb1 = model.encode([text1])[0]
-    emb2 = model.encode([text2])[0]
-    sim = cosine_similarity([emb1], [emb2])[0][0]
-    return float(sim)
+    return float(compute_similarities([(text1, text2)])[0])
+
+
+# API to compute the similarities get_eval_data needs for every PDF of a run, in one batched pass
+def compute_run_similarities(runs: List[tuple]) -> List[tuple]:
+    """
+    runs holds (story_image, story_ocr, story_ocr_image) per PDF. Returns, per PDF,
+    (ocr vs image, ocr+image vs image) cosine similarities to pass to get_eval_data(similarities=...).
+    """
+    pairs = []
+    for story_image, story_ocr, story_ocr_image in runs:
+        pairs += [(story_ocr, story_image), (story_ocr_image, story_image)]
+    sims = compute_similarities(pairs).tolist()
+    return [tuple(sims[i:i + 2]) for i in range(0, len(sims), 2)]
 
 # Compute all evaluation metrics for the given stories
-def get_eval_data(story_image, story_ocr, story_ocr_image):
+# (bertscores / similarities: precomputed from compute_run_bertscores / compute_run_similarities,
+# otherwise scored here)
+def get_eval_data(story_image, story_ocr, story_ocr_image, bertscores=None, similarities=None):
     readability_image = compute_readability(story_image)
     readability_ocr = compute_readability(story_ocr)
     readability_ocr_image = compute_readability(story_ocr_image)
@@ -42,11 +193,13 @@ def get_eval_data(story_image, story_ocr, story_ocr_image):
     word_count_ocr = len(story_ocr.split())
     word_count_ocr_image = len(story_ocr_image.split())
 
-    bertscore_ocr_vs_image = compute_bertscore(story_ocr, story_image)
-    bertscore_ocr_image_vs_image = compute_bertscore(story_ocr_image, story_image)
+    if bertscores is None:
+        bertscores = compute_run_bertscores([(story_image, story_ocr, story_ocr_image)])[0]
+    bertscore_ocr_vs_image, bertscore_ocr_image_vs_image = bertscores
 
-    similarity_ocr_vs_image = compute_cosine_similarity(story_ocr, story_image)
-    similarity_ocr_image_vs_image = compute_cosine_similarity(story_ocr_image, story_image)
+    if similarities is None:
+        similarities = compute_run_similarities([(story_image, story_ocr, story_ocr_image)])[0]
+    similarity_ocr_vs_image, similarity_ocr_image_vs_image = similarities
     # Build evaluation matrix
     eval_data = {
         "Metric": [
@@ -74,6 +227,8 @@ def get_eval_data(story_image, story_ocr, story_ocr_image):
             round(readability_image["flesch_reading_ease"], 2),
             round(readability_image["flesch_kincaid_grade"], 2),
             word_count_image,
+            np.nan,
+            np.nan
         ]
     }
     return pd.DataFrame(eval_data)
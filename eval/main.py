@@ -1,17 +1,13 @@
 from dotenv import load_dotenv
 import os
-from utils import pdf_to_images, run_ocr_on_image , describe_comic_pages_with_gpt4o
-from pipeline import process_entire_comic, pdf_ocr_to_story, pdf_image_to_story
-from eval import get_eval_data
-import glob
-import pandas as pd
+import sys
 
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
 
 # Print the current working directory to verify where Python is looking for the .env file
 print("Current working directory:", os.getcwd())
 
-# Load the .env file
+# Load the .env file (before importing the pipeline modules, which read their settings from it)
 load_dotenv()
 
 # Print the API key (first few characters for security)
@@ -21,6 +17,20 @@ if api_key:
 else:
     print("No API key found")
 
+# comicverse_common.py (shared with the app) lives in the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+from comicverse_common import job_workspace
+from utils import prepare_comic
+from pipeline import process_entire_comic, pdf_ocr_to_story, pdf_image_to_story
+from eval import get_eval_data, compute_run_bertscores, compute_run_similarities
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import glob
+import json
+import pandas as pd
+
 #pdf_path = "Comic_book_English.pdf"  # or your actual PDF file path
 
 '''
@@ -86,40 +96,110 @@ if __name__ == "__main__":
 
 
 
-pdf_files = glob.glob("*.pdf")
-all_results = []
-failed_pdfs = []
-
-for pdf_path in pdf_files:
-    try:
-        print(f"Processing: {pdf_path}")
-        story_image = pdf_image_to_story(pdf_path, temp_folder="comic_pages")
-        print("=== Output of pdf_image_to_story completed===\n")
-        story_ocr = pdf_ocr_to_story(pdf_path, temp_folder="comic_pages")
-        print("=== Output of pdf_ocr_to_story completed===\n")
-        story_ocr_image = process_entire_comic(pdf_path, temp_folder="comic_pages")
-        print("=== Output of process_entire_comic completed===\n")
-        df = get_eval_data(story_image, story_ocr, story_ocr_image)
-        df["PDF"] = pdf_path
+# The three pipelines compared for every PDF, by the column name used in the stories checkpoint
+PIPELINES = {
+    "story_image": pdf_image_to_story,
+    "story_ocr": pdf_ocr_to_story,
+    "story_ocr_image": process_entire_comic,
+}
+
+
+def generate_stories(pdf_path: str, ocr_workers: int = None) -> dict:
+    """
+    Renders and OCRs the PDF once, then runs the three pipelines on it concurrently.
+    """
+    # Scratch directory for the rendered pages, removed afterwards
+    with job_workspace() as workspace:
+        comic = prepare_comic(pdf_path, temp_folder=workspace, ocr_workers=ocr_workers)
+        with ThreadPoolExecutor(max_workers=len(PIPELINES)) as pool:
+            futures = {name: pool.submit(pipeline, comic) for name, pipeline in PIPELINES.items()}
+            return {"PDF": pdf_path, **{name: future.result() for name, future in futures.items()}}
+
+
+def load_scored_pdfs(results_csv: str) -> set:
+    # PDFs that already have rows in the combined results
+    if not os.path.exists(results_csv):
+        return set()
+    return set(pd.read_csv(results_csv, usecols=["PDF"], on_bad_lines="skip")["PDF"])
+
+
+def load_stories(stories_path: str) -> dict:
+    # Stories generated by earlier (possibly interrupted) runs, by PDF; a truncated last line is ignored
+    stories = {}
+    if os.path.exists(stories_path):
+        with open(stories_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                stories[record["PDF"]] = record
+    return stories
+
+
+def score_and_save(records: list, results_csv: str) -> None:
+    # BERTScore and embedding similarities for every PDF are computed up front in batches;
+    # results are appended to the combined CSV, not rewritten
+    if not records:
+        return
+    runs = [(r["story_image"], r["story_ocr"], r["story_ocr_image"]) for r in records]
+    scores = zip(compute_run_bertscores(runs), compute_run_similarities(runs))
+    for record, run, (bertscores, similarities) in zip(records, runs, scores):
+        df = get_eval_data(*run, bertscores=bertscores, similarities=similarities)
+        df["PDF"] = record["PDF"]
         # Save individual result
-        df.to_csv(f"eval_{os.path.splitext(os.path.basename(pdf_path))[0]}.csv", index=False)
-        all_results.append(df)
-        # Save combined results so far (acts as a checkpoint)
-        pd.concat(all_results, ignore_index=True).to_csv("all_comic_eval_results.csv", index=False)
-        print(f"Saved results for {pdf_path}")
-    except Exception as e:
-        print(f"Error processing {pdf_path}: {e}")
-        failed_pdfs.append(pdf_path)
-        continue
+        df.to_csv(f"eval_{os.path.splitext(os.path.basename(record['PDF']))[0]}.csv", index=False)
+        df.to_csv(results_csv, mode="a", header=not os.path.exists(results_csv), index=False)
+        print(f"Saved results for {record['PDF']}")
 
-if failed_pdfs:
-    print("The following PDFs failed and were not processed:")
-    for pdf in failed_pdfs:
-        print(pdf)
-else:
-    print("All PDFs processed successfully.")
 
-print("Final results saved to all_comic_eval_results.csv")
+# Guarded so worker processes (e.g. the OCR pool) can import this module safely
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate and evaluate stories for every comic PDF.")
+    parser.add_argument("--pattern", default="*.pdf", help="glob of PDFs to evaluate")
+    parser.add_argument("--workers", type=int, default=4, help="PDFs generated concurrently")
+    parser.add_argument("--stories", default="eval_stories.jsonl", help="checkpoint of generated stories")
+    parser.add_argument("--output", default="all_comic_eval_results.csv", help="combined results CSV")
+    args = parser.parse_args()
+
+    pdf_files = sorted(glob.glob(args.pattern))
+    scored = load_scored_pdfs(args.output)
+    stories = load_stories(args.stories)
+    todo = [pdf for pdf in pdf_files if pdf not in scored]
+    print(f"{len(pdf_files) - len(todo)} PDFs already evaluated, {len(todo)} to go")
+    failed_pdfs = []
+
+    # Each PDF OCRs on its own process pool; split the cores between the concurrent PDFs
+    ocr_workers = max(1, (os.cpu_count() or 1) // args.workers)
+    with ThreadPoolExecutor(max_workers=args.workers) as pool, open(args.stories, "a", encoding="utf-8") as out:
+        futures = {
+            pool.submit(generate_stories, pdf_path, ocr_workers): pdf_path
+            for pdf_path in todo if pdf_path not in stories
+        }
+        for future in as_completed(futures):
+            pdf_path = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                print(f"Error processing {pdf_path}: {e}")
+                failed_pdfs.append(pdf_path)
+                continue
+            print(f"=== Stories for {pdf_path} completed===\n")
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            stories[pdf_path] = record
+
+    # Score every generated-but-unscored PDF (including ones left by an interrupted run) together
+    score_and_save([stories[pdf] for pdf in todo if pdf in stories], args.output)
+
+    if failed_pdfs:
+        print("The following PDFs failed and were not processed:")
+        for pdf in failed_pdfs:
+            print(pdf)
+    else:
+        print("All PDFs processed successfully.")
+
+    print(f"Final results saved to {args.output}")
 
 
 '''
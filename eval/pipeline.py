@@ -1,40 +1,52 @@
-from utils import pdf_to_images, run_ocr_on_image, describe_comic_pages_with_gpt4o, safe_openai_call
-import re
-import openai
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
 import base64
+
+# comicverse_common.py (shared with the app) lives in the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+from comicverse_common import estimate_output_tokens, plan_batches
+from utils import (
+    PreparedComic, describe_comic_pages_structured, request_page_narrations, safe_openai_call,
+    estimate_payload_tokens,
+)
+
+# Narration batches of one comic requested at once; the shared rate limiter
+# (comicverse_common.api_limiter) keeps them, and the PDFs run concurrently by main.py, under the API limits
+BATCH_WORKERS = 4
+
 # Pipeline 
 # PDF -> OCR + Images (batched) -> GPT-4o for page narrations -> Aggregate into short story
-def process_entire_comic(pdf_path: str, temp_folder: str) -> str:
+def process_entire_comic(comic: PreparedComic) -> str:
     """
-    1. Convert PDF → images in temp_folder.
-    2. Run OCR on each.
-    3. Batch images in chunks of 5, calling GPT-4o for page-wise narrations.
-    4. Parse and collect per-page summaries with robust regex.
-    5. Combine all summaries into a cohesive short story.
+    1. Take the pages, JPEG payloads and OCR text already prepared for the PDF.
+    2. Pack pages into batches sized by their estimated image and narration tokens,
+       calling GPT-4o concurrently for page-wise narrations with max_tokens scaled to each batch.
+    3. Collect the structured per-page narrations by page number (skipped pages are re-requested alone).
+    4. Combine all summaries into a cohesive short story.
     Returns the final combined story text.
     """
-    # Step A: Convert PDF → PNGs
-    page_images = pdf_to_images(pdf_path, temp_folder)
-
-    # Step B: OCR
-    ocr_texts = [run_ocr_on_image(p) for p in page_images]
-
-    # Step C: Batch describe pages
-    page_summaries: List[str] = []
-    for i in range(0, len(page_images), 3):
-        chunk_imgs = page_images[i : i + 3]
-        chunk_ocr = ocr_texts[i : i + 3]
-        combined = describe_comic_pages_with_gpt4o(chunk_imgs, chunk_ocr)
-
-        pattern = r"Page\s*(\d+):\s*(.*?)(?=Page\s*\d+:|$)"
-        matches = re.finditer(pattern, combined, re.DOTALL)
-        for match in matches:
-            page_num = int(match.group(1))
-            text = match.group(2).strip()
-            # Insert at correct absolute page index
-            absolute_index = i + (page_num - 1)
-            if absolute_index < len(page_images):
-                page_summaries.append(text)
+    ocr_texts = comic.ocr_texts
+
+    # Batch describe pages, packing batches by token budget
+    input_tokens = [estimate_payload_tokens(p, o) for p, o in zip(comic.jpeg_payloads, ocr_texts)]
+    output_tokens = [estimate_output_tokens(o) for o in ocr_texts]
+    def describe(batch):
+        return describe_comic_pages_structured(
+            [comic.jpeg_payloads[i] for i in batch.items],
+            [ocr_texts[i] for i in batch.items],
+            [i + 1 for i in batch.items],
+            max_tokens=batch.max_tokens,
+        )
+
+    narrations = {}
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        for batch_narrations in pool.map(describe, plan_batches(input_tokens, output_tokens)):
+            narrations.update(batch_narrations)
+    page_summaries: List[str] = [narrations[n] for n in sorted(narrations)]
 
     # Step D: Aggregate all page_summaries into one story
     aggregate_prompt = (
@@ -62,43 +74,38 @@ def process_entire_comic(pdf_path: str, temp_folder: str) -> str:
 
 
 #Pipeline 2: PDF → OCR → GPT Story
-def pdf_ocr_to_story(pdf_path: str, temp_folder: str) -> str:
+def pdf_ocr_to_story(comic: PreparedComic) -> str:
     """
     Pipeline 2: PDF → Images → OCR → GPT Story (batched OCR to GPT, then aggregate)
+    Uses the OCR text already prepared for the PDF.
     """
-    # Convert PDF to images
-    page_images = pdf_to_images(pdf_path, temp_folder)
-    # Run OCR on each image
-    ocr_texts = [run_ocr_on_image(img) for img in page_images]
-
-    # Batch OCR texts in chunks of 3, send to GPT for narration per batch
-    page_summaries = []
-    for i in range(0, len(page_images), 3):
-        chunk_ocr = ocr_texts[i : i + 3]
+    page_images = comic.page_images
+    ocr_texts = comic.ocr_texts
+
+    def build_messages(page_numbers):
         chunk_prompt = (
             "You are a story-writing assistant. Here are OCR-extracted texts from consecutive comic pages:\n\n"
         )
-        for idx, ocr in enumerate(chunk_ocr, start=1):
-            chunk_prompt += f"--- Page {i+idx} ---\n{ocr.strip()}\n\n"
+        for page_num in page_numbers:
+            chunk_prompt += f"--- Page {page_num} ---\n{ocr_texts[page_num - 1].strip()}\n\n"
         chunk_prompt += (
-            "For each page, write a detailed narration labeled as 'Page 1:', 'Page 2:', etc. "
-            "Include characters, actions, settings, and dialogues."
+            "For each page, write a detailed narration. Include characters, actions, settings, and dialogues. "
+            "Return one entry per page, with page_index set to the page number shown in its header."
         )
-        response = safe_openai_call(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are a story-writing assistant."},
-                {"role": "user", "content": chunk_prompt},
-            ],
-            temperature=0.7,
-            max_tokens=750,
-        )
-        combined = response.choices[0].message.content.strip()
-        pattern = r"Page\s*(\d+):\s*(.*?)(?=Page\s*\d+:|$)"
-        matches = re.finditer(pattern, combined, re.DOTALL)
-        for match in matches:
-            text = match.group(2).strip()
-            page_summaries.append(text)
+        return [
+            {"role": "system", "content": "You are a story-writing assistant."},
+            {"role": "user", "content": chunk_prompt},
+        ]
+
+    # Batch OCR texts in chunks of 3, requested concurrently; narrations keyed by absolute page number
+    batches = [list(range(i + 1, min(i + 3, len(page_images)) + 1)) for i in range(0, len(page_images), 3)]
+    narrations = {}
+    with ThreadPoolExecutor(max_workers=BATCH_WORKERS) as pool:
+        for batch_narrations in pool.map(
+            lambda page_numbers: request_page_narrations(build_messages, page_numbers, max_tokens=750), batches
+        ):
+            narrations.update(batch_narrations)
+    page_summaries = [narrations[n] for n in sorted(narrations)]
 
     # Aggregate all page_summaries into one story
     aggregate_prompt = (
@@ -125,13 +132,13 @@ def pdf_ocr_to_story(pdf_path: str, temp_folder: str) -> str:
 
 #Pipeline 3: PDF → Images→ GPT Story  Baseline
 
-def pdf_image_to_story(pdf_path: str, temp_folder: str) -> str:
+def pdf_image_to_story(comic: PreparedComic) -> str:
     """
     Pipeline: PDF → Images → GPT-4o (no OCR) → Story
-    Converts all PDF pages to images and sends ALL images at once to GPT-4o for a single story.
+    Sends ALL already-rendered page images at once to GPT-4o for a single story.
     """
-    # Step 1: Convert PDF to images
-    page_images = pdf_to_images(pdf_path, temp_folder)
+    # Step 1: Use the pages already rendered for the PDF
+    page_images = comic.page_images
 
     # Step 2: Send all images at once to GPT-4o (no OCR)
     prompt = (
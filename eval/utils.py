@@ -1,29 +1,27 @@
-from dotenv import load_dotenv
 import os
-import openai
-from pdf2image import convert_from_path
-import pytesseract
+import sys
+from pdf2image import convert_from_path, pdfinfo_from_path
 from PIL import Image
-import platform
 import base64
-from typing import List, Optional
-import re
-import time
+from typing import Iterator, List, Optional
 import io
+import json
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
 
+# Workspaces, the retry layer, batch planning and the OCR cache are shared with the app,
+# so both use one breaker, one set of retry stats and one OCR cache
+# comicverse_common.py (shared with the app) lives in the repository root
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if REPO_ROOT not in sys.path:
+    sys.path.insert(0, REPO_ROOT)
+from comicverse_common import (
+    MAX_PAGES_PER_BATCH, call_with_retry, check_workspace_quota, estimate_image_tokens,
+    get_ocr_cache, get_pytesseract, init_ocr_worker, openai,
+)
 
-# Print the current working directory to verify where Python is looking for the .env file
-print("Current working directory:", os.getcwd())
-
-# Load the .env file
-load_dotenv()
-
-# Print the API key (first few characters for security)
-api_key = os.getenv("OPENAI_API_KEY")
-if api_key:
-    print("API key found:", api_key[:4] + "..." + api_key[-4:])
-else:
-    print("No API key found")
+# Importing this module does no work: main.py loads the .env file before importing it,
+# and openai / pytesseract are only imported on first use
 
 
 # response = openai.chat.completions.create(
@@ -38,53 +36,134 @@ else:
 # response.model_dump()
 # print(response.choices[0].message.content)
 
-# API to convert PDF pages to high-resolution PNG images
-def pdf_to_images(pdf_path: str, output_folder: str, dpi: int = 300) -> list[str]:
+# Disk quota for one job's workspace (300 DPI PNGs are large)
+WORKSPACE_QUOTA_BYTES = int(os.getenv("COMICVERSE_WORKSPACE_QUOTA_MB", "4096")) * 1024 * 1024
+
+
+# API to rasterize PDF pages a few at a time, yielding (page number, PIL image)
+def _iter_rendered(pdf_path: str, dpi: int, window: int) -> Iterator[tuple]:
+    # On Mac/Linux, poppler must be installed and in PATH (e.g., via `brew install poppler`)
+    page_count = pdfinfo_from_path(pdf_path)["Pages"]
+
+    for first in range(1, page_count + 1, window):
+        last = min(first + window - 1, page_count)
+        pages = convert_from_path(pdf_path, dpi=dpi, first_page=first, last_page=last)
+        for i in range(first, last + 1):
+            if not pages:
+                break
+            page = pages.pop(0)
+            try:
+                yield i, page
+            finally:
+                page.close()
+
+
+# API to convert PDF pages to high-resolution PNG images, a few pages at a time
+def iter_pdf_pages(
+    pdf_path: str,
+    output_folder: str,
+    dpi: int = 300,
+    window: int = 2,
+    quota_bytes: Optional[int] = None
+) -> Iterator[str]:
     """
-    Converts each page of the given PDF into a high-resolution PNG.
-    Returns a list of file paths for the extracted images.
+    Rasterizes the PDF `window` pages at a time and yields each PNG path as soon as it is written.
+    At most `window` full-resolution pages are held in memory, however long the PDF is.
+    Raises WorkspaceQuotaExceeded once output_folder grows past quota_bytes.
     """
     os.makedirs(output_folder, exist_ok=True)
-
-    # On Mac/Linux, poppler must be installed and in PATH (e.g., via `brew install poppler`)
-    pages = convert_from_path(pdf_path, dpi=dpi)
-    
-    image_paths = []
-    for i, page in enumerate(pages, start=1):
+    for i, page in _iter_rendered(pdf_path, dpi, window):
         img_filename = os.path.join(output_folder, f"page_{i:03d}.png")
         page.save(img_filename, "PNG")
-        image_paths.append(img_filename)
+        check_workspace_quota(output_folder, quota_bytes)
+        yield img_filename
 
-    return image_paths
+
+# API to convert PDF pages to high-resolution PNG images
+def pdf_to_images(
+    pdf_path: str, output_folder: str, dpi: int = 300, quota_bytes: Optional[int] = None
+) -> list[str]:
+    """
+    Converts each page of the given PDF into a high-resolution PNG.
+    Returns a list of file paths for the extracted images.
+    """
+    return list(iter_pdf_pages(pdf_path, output_folder, dpi=dpi, quota_bytes=quota_bytes))
 
 
 # API to run Tesseract OCR on images
-if platform.system() == "Windows":
-    pytesseract.pytesseract.tesseract_cmd = r"C:\Program Files\Tesseract-OCR\tesseract.exe"
-else:
-    pytesseract.pytesseract.tesseract_cmd = "/opt/homebrew/bin/tesseract"  # or use `which tesseract`
-
 def run_ocr_on_image(image_path: str, lang: str = "eng") -> str:
     """
     Runs Tesseract OCR on the given image and returns the recognized text.
     """
     img = Image.open(image_path)
-    text = pytesseract.image_to_string(img, lang=lang)
+    text = get_pytesseract().image_to_string(img, lang=lang)
     return text
 
+
+# API to run Tesseract OCR on many images in parallel worker processes
+def run_ocr_on_images(
+    image_paths: List[str],
+    workers: Optional[int] = None,
+    tesseract_threads: int = 1,
+    lang: str = "eng",
+    dpi: Optional[int] = None,
+    use_cache: bool = True
+) -> List[str]:
+    """
+    Runs OCR on each image on a process pool of `workers` processes, reusing cached results.
+    Returns the recognized texts in the same order as image_paths.
+    """
+    texts: List[Optional[str]] = [None] * len(image_paths)
+    cache = get_ocr_cache() if use_cache else None
+    misses = []
+    for i, path in enumerate(image_paths):
+        image_bytes = None
+        if cache is not None:
+            with open(path, "rb") as f:
+                image_bytes = f.read()
+            texts[i] = cache.get(image_bytes, dpi, lang)
+        if texts[i] is None:
+            misses.append((i, path, image_bytes))
+    if not misses:
+        return texts
+
+    workers = min(workers or os.cpu_count() or 1, len(misses))
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_ocr_worker, initargs=(tesseract_threads,)
+    ) as pool:
+        results = pool.map(run_ocr_on_image, [path for _, path, _ in misses], [lang] * len(misses))
+        for (i, _, image_bytes), text in zip(misses, results):
+            texts[i] = text
+            if cache is not None:
+                cache.put(image_bytes, text, dpi, lang)
+    return texts
+
+
+# API to estimate the prompt tokens of one page from its JPEG payload and OCR text
+def estimate_payload_tokens(jpeg_b64: str, ocr_text: str) -> int:
+    with Image.open(io.BytesIO(base64.b64decode(jpeg_b64))) as img:
+        width, height = img.size
+    return estimate_image_tokens(width, height) + len(ocr_text.strip()) // 4 + 10
+
+
 # API to describe comic pages using GPT-4o
 def describe_comic_pages_with_gpt4o(
     image_paths: List[str],
     ocr_texts: Optional[List[str]] = None,
     model: str = "gpt-4o-mini",
     temperature: float = 0.7,
-    max_tokens: int = 600
+    max_tokens: int = 600,
+    image_payloads: Optional[List[str]] = None
 ) -> str:
-
+    """
+    Narrates up to MAX_PAGES_PER_BATCH pages in one call; use plan_batches to size batches
+    and max_tokens. Pass image_payloads (base64 JPEGs, e.g. from PreparedComic.jpeg_payloads)
+    to skip re-compressing the images.
+    """
     if not image_paths:
         raise ValueError("At least one image path must be provided.")
-    if len(image_paths) > 3:
-        raise ValueError("A maximum of 3 images can be processed at once.")
+    if len(image_paths) > MAX_PAGES_PER_BATCH:
+        raise ValueError(f"A maximum of {MAX_PAGES_PER_BATCH} images can be processed at once.")
 
     # Prepare OCR texts
     if ocr_texts is None:
@@ -93,9 +172,12 @@ def describe_comic_pages_with_gpt4o(
         raise ValueError("The number of OCR texts must match the number of image paths.")
 
     # Encode images
+    if image_payloads is None:
+        image_payloads = [compress_image(p, max_width=1024, quality=70) for p in image_paths]
+    if len(image_payloads) != len(image_paths):
+        raise ValueError("The number of image payloads must match the number of image paths.")
     blocks: List[dict] = []
-    for img_path in image_paths:
-        img_b64 = compress_image(img_path, max_width=1024, quality=70)
+    for img_b64 in image_payloads:
         blocks.append({
             "type": "image_url",
             "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}
@@ -119,7 +201,7 @@ def describe_comic_pages_with_gpt4o(
             })
 
     # Call GPT-4o
-    response = openai.chat.completions.create(
+    response = safe_openai_call(
         model=model,
         messages=[
             {"role": "system", "content": "You are a helpful assistant that reads comics."},
@@ -131,19 +213,156 @@ def describe_comic_pages_with_gpt4o(
     return response.choices[0].message.content.strip()
 
 
+# JSON schema for structured page narrations (response_format)
+PAGE_NARRATIONS_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "page_narrations",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "pages": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "page_index": {"type": "integer"},
+                            "narration": {"type": "string"},
+                        },
+                        "required": ["page_index", "narration"],
+                        "additionalProperties": False,
+                    },
+                }
+            },
+            "required": ["pages"],
+            "additionalProperties": False,
+        },
+    },
+}
 
-# API call wrapper to handle rate limits
-def safe_openai_call(*args, **kwargs):
-    while True:
+
+# API to read a structured narration response into {page number: narration}
+def parse_structured_narrations(content: str, page_numbers: List[int]) -> dict:
+    """
+    Keeps only non-empty narrations for the requested page numbers.
+    Unparseable (e.g. truncated) JSON yields {}.
+    """
+    try:
+        pages = json.loads(content)["pages"]
+    except (json.JSONDecodeError, KeyError, TypeError):
+        return {}
+    wanted = set(page_numbers)
+    narrations = {}
+    for page in pages:
         try:
-            return openai.chat.completions.create(*args, **kwargs)
-        except openai.RateLimitError as e:
-            print("Rate limit hit. Waiting 5 seconds...")
-            time.sleep(5)
+            page_num = int(page["page_index"])
+            text = str(page["narration"]).strip()
+        except (KeyError, TypeError, ValueError):
+            continue
+        if page_num in wanted and text:
+            narrations[page_num] = text
+    return narrations
+
+
+def _structured_call(messages, page_numbers, model, temperature, max_tokens) -> dict:
+    response = safe_openai_call(
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        response_format=PAGE_NARRATIONS_FORMAT,
+    )
+    return parse_structured_narrations(response.choices[0].message.content or "", page_numbers)
+
+
+# API to get narrations keyed by page number, re-requesting any skipped page on its own
+def request_page_narrations(
+    build_messages,
+    page_numbers: List[int],
+    model: str = "gpt-4o-mini",
+    temperature: float = 0.7,
+    max_tokens: int = 750
+) -> dict:
+    """
+    build_messages(page_numbers) returns the chat messages asking for those pages.
+    The whole batch is requested once in structured mode; pages the model skipped or merged
+    are then re-requested one at a time instead of re-sending the batch.
+    Returns {page number: narration}.
+    """
+    narrations = _structured_call(build_messages(page_numbers), page_numbers, model, temperature, max_tokens)
+    single_max_tokens = max(300, max_tokens // len(page_numbers) + 100)
+    for page_num in page_numbers:
+        if page_num not in narrations:
+            narrations.update(
+                _structured_call(build_messages([page_num]), [page_num], model, temperature, single_max_tokens)
+            )
+    return narrations
+
+
+# API to describe comic pages using GPT-4o, returning {absolute page number: narration}
+def describe_comic_pages_structured(
+    image_payloads: List[str],
+    ocr_texts: List[str],
+    page_numbers: List[int],
+    model: str = "gpt-4o-mini",
+    temperature: float = 0.7,
+    max_tokens: int = 600
+) -> dict:
+    """
+    Structured counterpart of describe_comic_pages_with_gpt4o. Each image is labelled with its
+    absolute page number and the model returns JSON keyed by it, so a skipped page can't shift
+    the others; skipped pages are retried individually.
+    """
+    if not page_numbers:
+        raise ValueError("At least one page must be provided.")
+    if len(page_numbers) > MAX_PAGES_PER_BATCH:
+        raise ValueError(f"A maximum of {MAX_PAGES_PER_BATCH} images can be processed at once.")
+    if not len(image_payloads) == len(ocr_texts) == len(page_numbers):
+        raise ValueError("image_payloads, ocr_texts and page_numbers must have the same length.")
+    pages = dict(zip(page_numbers, zip(image_payloads, ocr_texts)))
+
+    prompt = (
+        "You are a comic-book interpreter. Each image I send is preceded by its page number. "
+        "For each image, please provide a detailed narration of that page. "
+        "Include characters, actions, settings, and dialogues. "
+        "Return one entry per image, with page_index set to that page's number."
+    )
+
+    def build_messages(numbers):
+        user_content = [{"type": "text", "text": prompt}]
+        for page_num in numbers:
+            img_b64, ocr_text = pages[page_num]
+            user_content.append({"type": "text", "text": f"Page {page_num}:"})
+            user_content.append({
+                "type": "image_url",
+                "image_url": {"url": f"data:image/jpeg;base64,{img_b64}"}
+            })
+            if ocr_text.strip():
+                user_content.append({
+                    "type": "text",
+                    "text": f"OCR for Page {page_num}:\n" + ocr_text.strip()
+                })
+        return [
+            {"role": "system", "content": "You are a helpful assistant that reads comics."},
+            {"role": "user", "content": user_content}
+        ]
+
+    return request_page_narrations(build_messages, page_numbers, model, temperature, max_tokens)
+
+
+# API call wrapper to handle rate limits, timeouts and server errors
+def safe_openai_call(*args, **kwargs):
+    return call_with_retry(openai.chat.completions.create, *args, **kwargs)
 
 # API call to compress iamge if exceed limit 
 def compress_image(image_path, max_width=1024, quality=70):
-    img = Image.open(image_path)
+    with Image.open(image_path) as img:
+        return compress_pil_image(img, max_width=max_width, quality=quality)
+
+
+# API to compress an already-decoded image to a base64 JPEG payload
+def compress_pil_image(img, max_width=1024, quality=70):
     # Resize if wider than max_width
     if img.width > max_width:
         ratio = max_width / img.width
@@ -157,3 +376,39 @@ def compress_image(image_path, max_width=1024, quality=70):
     img_b64 = base64.b64encode(buffer.read()).decode("utf-8")
     return img_b64
 
+
+# A comic rendered, compressed and OCR'd once, shared by all pipelines
+@dataclass
+class PreparedComic:
+    pdf_path: str
+    page_images: List[str]     # full-resolution PNGs on disk
+    jpeg_payloads: List[str]   # base64 JPEGs as sent to GPT-4o
+    ocr_texts: List[str]
+
+
+# API to do every expensive per-PDF step once before running the pipelines
+def prepare_comic(
+    pdf_path: str,
+    temp_folder: str,
+    dpi: int = 300,
+    quota_bytes: Optional[int] = WORKSPACE_QUOTA_BYTES,
+    ocr_workers: Optional[int] = None
+) -> PreparedComic:
+    """
+    Renders the PDF once into temp_folder (ideally a job_workspace()), then builds the compressed
+    JPEG payloads and the OCR text for every page (on ocr_workers processes).
+    The result is passed to process_entire_comic, pdf_ocr_to_story and pdf_image_to_story.
+    """
+    os.makedirs(temp_folder, exist_ok=True)
+    page_images = []
+    jpeg_payloads = []
+    for i, page in _iter_rendered(pdf_path, dpi, window=2):
+        # The PNG is written once (baseline payload + OCR input); the JPEG payload
+        # is built from the same in-memory render instead of re-reading the PNG
+        img_filename = os.path.join(temp_folder, f"page_{i:03d}.png")
+        page.save(img_filename, "PNG")
+        check_workspace_quota(temp_folder, quota_bytes)
+        page_images.append(img_filename)
+        jpeg_payloads.append(compress_pil_image(page, max_width=1024, quality=70))
+    ocr_texts = run_ocr_on_images(page_images, workers=ocr_workers, dpi=dpi)
+    return PreparedComic(pdf_path, page_images, jpeg_payloads, ocr_texts)
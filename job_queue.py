@@ -0,0 +1,494 @@
+import argparse
+import atexit
+import hashlib
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from typing import Iterable, List, Optional
+
+from comicToStory_audio_batching import AUDIO_DIR, generate_speech, iter_process_entire_comic, iter_translate_text
+from comicverse_common import CACHE_DIR, REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE, api_limiter, job_workspace
+
+#--------------------------------------------
+# SQLite-backed job queue
+#--------------------------------------------
+
+JOB_DB_PATH = os.path.join(CACHE_DIR, "jobs.sqlite")
+JOB_WORKERS = int(os.getenv("COMICVERSE_JOB_WORKERS", "2"))
+# Finished jobs (and any input files they left behind) are deleted after this long
+JOB_RETENTION_SECONDS = float(os.getenv("COMICVERSE_JOB_RETENTION_DAYS", "7")) * 24 * 3600
+JOB_PRUNE_INTERVAL_SECONDS = 3600
+
+ACTIVE_STATUSES = ("queued", "running")
+FINISHED_STATUSES = ("done", "failed", "cancelled")
+
+
+class JobCancelled(Exception):
+    """Raised inside a worker once its job has been cancelled."""
+
+
+class JobQueue:
+    """
+    Jobs shared between the Streamlit server and the worker processes through one SQLite file.
+    Each job has an id, a kind ("story" or "audio"), JSON params, a status
+    (queued -> running -> done / failed / cancelled), a progress label, the partial story text
+    while it streams, the playable prefix of the audiobook while it is synthesized (partial_audio),
+    and a JSON result. Identical submissions (same kind, params and input
+    bytes) return the existing job id while it is queued or running, or done with its audiobook
+    still on disk; finished jobs are pruned after JOB_RETENTION_SECONDS.
+    Each submitter (e.g. a browser session) is recorded as a waiter of the job it got back, and a
+    shared job is only cancelled once every waiter has cancelled it.
+    """
+    def __init__(self, path: str = None):
+        self.path = path or JOB_DB_PATH
+        self.input_dir = os.path.join(os.path.dirname(self.path) or ".", "job_inputs")
+        self._last_prune = 0.0
+        os.makedirs(self.input_dir, exist_ok=True)
+        conn = self._connect()
+        try:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, dedup_key TEXT NOT NULL, kind TEXT NOT NULL, params TEXT NOT NULL, "
+                "input_path TEXT, status TEXT NOT NULL, progress TEXT, partial TEXT, result TEXT, error TEXT, "
+                "cancel_requested INTEGER NOT NULL DEFAULT 0, worker_pid INTEGER, "
+                "created REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "partial_audio" not in columns:
+                conn.execute("ALTER TABLE jobs ADD COLUMN partial_audio TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_dedup ON jobs (dedup_key)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS job_waiters ("
+                "job_id TEXT NOT NULL, waiter TEXT NOT NULL, PRIMARY KEY (job_id, waiter))"
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=30)
+
+    def submit(self, kind: str, params: dict, payload: bytes = b"", waiter: Optional[str] = None) -> str:
+        """
+        Queues a job (payload is stored as its input file) and returns its id,
+        or the id of an identical job that is queued, running or done with its result still usable
+        and not being cancelled. waiter identifies the submitter for cancel().
+        """
+        if time.time() - self._last_prune > JOB_PRUNE_INTERVAL_SECONDS:
+            self.prune()
+        digest = hashlib.sha256(payload)
+        digest.update(b"\0" + json.dumps({"kind": kind, **params}, sort_keys=True).encode("utf-8"))
+        dedup_key = digest.hexdigest()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, status, result FROM jobs WHERE dedup_key = ? AND status IN ('queued', 'running', 'done') "
+                "AND cancel_requested = 0 ORDER BY created DESC",
+                (dedup_key,),
+            ).fetchall()
+            for existing_id, status, result in rows:
+                if status != "done" or _result_available(json.loads(result) if result else {}):
+                    self._add_waiter(conn, existing_id, waiter)
+                    conn.commit()
+                    return existing_id
+            job_id = uuid.uuid4().hex
+            input_path = None
+            if payload:
+                input_path = os.path.join(self.input_dir, f"{job_id}.bin")
+                with open(input_path, "wb") as f:
+                    f.write(payload)
+            now = time.time()
+            conn.execute(
+                "INSERT INTO jobs (id, dedup_key, kind, params, input_path, status, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, dedup_key, kind, json.dumps(params), input_path, now, now),
+            )
+            self._add_waiter(conn, job_id, waiter)
+            conn.commit()
+            return job_id
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _add_waiter(conn: sqlite3.Connection, job_id: str, waiter: Optional[str]) -> None:
+        if waiter is not None:
+            conn.execute("INSERT OR IGNORE INTO job_waiters (job_id, waiter) VALUES (?, ?)", (job_id, waiter))
+
+    def submit_story(
+        self, pdf_bytes: bytes, style: str, language: str, with_audio: bool = False, waiter: Optional[str] = None
+    ) -> str:
+        return self.submit(
+            "story", {"style": style, "language": language, "with_audio": with_audio}, pdf_bytes, waiter
+        )
+
+    def submit_audio(self, text: str, voice: str = "alloy", waiter: Optional[str] = None) -> str:
+        return self.submit("audio", {"text": text, "voice": voice}, waiter=waiter)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        conn = self._connect()
+        conn.row_factory = sqlite3.Row
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        job = dict(row)
+        job["params"] = json.loads(job["params"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def claim(self, worker_pid: int) -> Optional[dict]:
+        """
+        Atomically moves the oldest queued job to running and returns it (None if the queue is empty).
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+            ).fetchone()
+            if row is None:
+                conn.commit()
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', worker_pid = ?, updated = ? WHERE id = ?",
+                (worker_pid, time.time(), row[0]),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        return self.get(row[0])
+
+    def _set(self, job_id: str, **fields) -> None:
+        fields["updated"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        conn = self._connect()
+        try:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def update(
+        self,
+        job_id: str,
+        progress: Optional[str] = None,
+        partial: Optional[str] = None,
+        partial_audio: Optional[str] = None
+    ) -> None:
+        fields = {}
+        if progress is not None:
+            fields["progress"] = progress
+        if partial is not None:
+            fields["partial"] = partial
+        if partial_audio is not None:
+            fields["partial_audio"] = partial_audio
+        self._set(job_id, **fields)
+
+    def finish(self, job_id: str, result: dict) -> None:
+        self._set(job_id, status="done", result=json.dumps(result), partial=None, partial_audio=None)
+
+    def fail(self, job_id: str, error: str) -> None:
+        self._set(job_id, status="failed", error=error, partial_audio=None)
+
+    def mark_cancelled(self, job_id: str) -> None:
+        self._set(job_id, status="cancelled", partial=None, partial_audio=None)
+
+    def cancel(self, job_id: str, waiter: Optional[str] = None) -> bool:
+        """
+        Stops waiting on a job for waiter. Once no other waiter is left, cancels a queued job
+        immediately, or asks a running job to stop at its next progress update, and returns True;
+        returns False while other waiters still want the result.
+        """
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if waiter is not None:
+                conn.execute("DELETE FROM job_waiters WHERE job_id = ? AND waiter = ?", (job_id, waiter))
+            if conn.execute("SELECT 1 FROM job_waiters WHERE job_id = ? LIMIT 1", (job_id,)).fetchone():
+                conn.commit()
+                return False
+            now = time.time()
+            conn.execute(
+                "UPDATE jobs SET status = 'cancelled', updated = ? WHERE id = ? AND status = 'queued'",
+                (now, job_id),
+            )
+            conn.execute(
+                "UPDATE jobs SET cancel_requested = 1, updated = ? WHERE id = ? AND status = 'running'",
+                (now, job_id),
+            )
+            conn.commit()
+            row = conn.execute("SELECT status, input_path FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.close()
+        # A queued job never reaches a worker, so drop its input here
+        if row and row[0] == "cancelled" and row[1] and os.path.exists(row[1]):
+            os.remove(row[1])
+        return True
+
+    def cancel_requested(self, job_id: str) -> bool:
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            return bool(row and row[0])
+        finally:
+            conn.close()
+
+    def requeue_orphaned(self, live_pids: Iterable[int] = ()) -> int:
+        """
+        Puts running jobs whose worker is not one of live_pids (it died, or the server restarted)
+        back in the queue.
+        """
+        live_pids = set(live_pids)
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT id, worker_pid FROM jobs WHERE status = 'running'").fetchall()
+            orphaned = [(job_id,) for job_id, pid in rows if pid not in live_pids]
+            conn.executemany(
+                "UPDATE jobs SET status = 'queued', worker_pid = NULL, progress = NULL, partial = NULL, "
+                "partial_audio = NULL WHERE id = ?",
+                orphaned,
+            )
+            conn.commit()
+            return len(orphaned)
+        finally:
+            conn.close()
+
+    def prune(self, max_age: float = JOB_RETENTION_SECONDS) -> int:
+        """
+        Deletes finished jobs last updated more than max_age seconds ago, their input files, and
+        input files of jobs that no longer exist. Returns the number of jobs deleted.
+        """
+        self._last_prune = time.time()
+        cutoff = self._last_prune - max_age
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute(
+                "SELECT id, input_path FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND updated < ?",
+                (cutoff,),
+            ).fetchall()
+            conn.executemany("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id, _ in rows])
+            conn.executemany("DELETE FROM job_waiters WHERE job_id = ?", [(job_id,) for job_id, _ in rows])
+            conn.commit()
+            kept = {path for (path,) in conn.execute("SELECT input_path FROM jobs WHERE input_path IS NOT NULL")}
+        finally:
+            conn.close()
+        stale = [path for _, path in rows if path]
+        for name in os.listdir(self.input_dir):
+            path = os.path.join(self.input_dir, name)
+            # Skip files newer than the cutoff: submit writes the input just before inserting its row
+            if path not in kept and os.path.getmtime(path) < cutoff:
+                stale.append(path)
+        for path in stale:
+            if os.path.exists(path):
+                os.remove(path)
+        return len(rows)
+
+
+def _result_available(result: dict) -> bool:
+    # A done job can only be reused while the audiobook it produced is still stored
+    audio_rel = result.get("audio_rel")
+    return not audio_rel or os.path.exists(os.path.join(AUDIO_DIR, os.path.basename(audio_rel)))
+
+#--------------------------------------------
+# Worker processes
+#--------------------------------------------
+
+class _Progress:
+    """
+    Writes a job's progress label / partial text / partial audiobook at most every interval seconds,
+    raising JobCancelled when the job has been cancelled.
+    """
+    def __init__(self, queue: JobQueue, job_id: str, interval: float = 0.5):
+        self.queue = queue
+        self.job_id = job_id
+        self.interval = interval
+        self._last = 0.0
+
+    def report(
+        self,
+        label: Optional[str] = None,
+        partial: Optional[str] = None,
+        force: bool = False,
+        partial_audio: Optional[str] = None
+    ) -> None:
+        now = time.monotonic()
+        if not force and now - self._last < self.interval:
+            return
+        self._last = now
+        self.queue.update(self.job_id, label, partial, partial_audio)
+        if self.queue.cancel_requested(self.job_id):
+            raise JobCancelled(self.job_id)
+
+
+def _run_story_job(job: dict, progress: _Progress) -> dict:
+    params = job["params"]
+    narrations = []
+    story = ""
+    with job_workspace() as workspace:
+        events = iter_process_entire_comic(job["input_path"], workspace, style=params["style"])
+        try:
+            for event in events:
+                if event.kind == "token":
+                    story += event.data
+                    progress.report(partial=story)
+                elif event.kind == "page":
+                    progress.report(f"Read page {event.data['page']}...")
+                elif event.kind == "batch":
+                    pages = event.data["pages"]
+                    progress.report(f"Narrated pages {pages[0]}–{pages[-1]} (batch {event.data['batch']})")
+                elif event.kind == "narrations":
+                    narrations = event.data
+                elif event.kind == "aggregating":
+                    progress.report(f"Writing the story from {event.data['pages']} pages...", force=True)
+        finally:
+            events.close()
+    story = story.strip()
+
+    if params["language"].lower() == "hindi":
+        progress.report("Translating story...", partial="", force=True)
+        english, story = story, ""
+        for text in iter_translate_text(english, target_lang="hi"):
+            story += text
+            progress.report(partial=story)
+        story = story.strip()
+
+    result = {"story": story, "narrations": narrations, "audio_rel": None}
+    if params["with_audio"]:
+        progress.report("Generating audiobook...", partial=story, force=True)
+        result["audio_rel"] = _generate_audiobook(story, "alloy", progress)
+    return result
+
+
+def _generate_audiobook(text: str, voice: str, progress: _Progress) -> str:
+    # Publishes each in-order prefix of the book as it grows, so the page can start playing it
+    def on_progress(partial_rel: str, done: int, total: int) -> None:
+        progress.report(f"Generating audiobook ({done}/{total} parts ready)...", partial_audio=partial_rel, force=True)
+
+    return generate_speech(text, voice=voice, on_progress=on_progress)
+
+
+def _run_audio_job(job: dict, progress: _Progress) -> dict:
+    progress.report("Generating audiobook...", force=True)
+    return {"audio_rel": _generate_audiobook(job["params"]["text"], job["params"]["voice"], progress)}
+
+
+JOB_RUNNERS = {"story": _run_story_job, "audio": _run_audio_job}
+
+
+def run_worker(db_path: str = None, poll_interval: float = 0.5, stop: Optional[threading.Event] = None) -> None:
+    """
+    Worker loop: claims queued jobs one at a time and runs them until stop is set.
+    """
+    queue = JobQueue(db_path)
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        job = queue.claim(os.getpid())
+        if job is None:
+            stop.wait(poll_interval)
+            continue
+        try:
+            result = JOB_RUNNERS[job["kind"]](job, _Progress(queue, job["id"]))
+        except JobCancelled:
+            queue.mark_cancelled(job["id"])
+        except Exception as e:
+            queue.fail(job["id"], f"{type(e).__name__}: {e}")
+        else:
+            queue.finish(job["id"], result)
+        finally:
+            if job["input_path"] and os.path.exists(job["input_path"]):
+                os.remove(job["input_path"])
+
+
+def _stop_on_stdin_eof(stop: threading.Event) -> None:
+    # The server holds the write end of our stdin; EOF means it exited or stopped the pool
+    sys.stdin.buffer.read()
+    stop.set()
+
+
+class WorkerPool:
+    """
+    Keeps `workers` worker processes running against the job database. Each worker is a
+    `python job_queue.py` subprocess rather than a multiprocessing child, so it never re-runs the
+    Streamlit script, and inherits the server's environment and working directory. Workers are
+    not daemonic, since OCR inside a job uses its own process pool; they exit when their stdin
+    pipe closes, i.e. when the server process exits or calls stop().
+    The account's rate limits are split evenly between the server (chat) and the workers, so all
+    processes together stay under COMICVERSE_REQUESTS_PER_MINUTE / COMICVERSE_TOKENS_PER_MINUTE.
+    """
+    def __init__(self, workers: int = JOB_WORKERS, db_path: str = None):
+        self.workers = workers
+        self.db_path = db_path or JOB_DB_PATH
+        self._processes: List[subprocess.Popen] = []
+        self._lock = threading.Lock()
+        share = 1 / (workers + 1)
+        self._requests_per_minute = REQUESTS_PER_MINUTE * share
+        self._tokens_per_minute = TOKENS_PER_MINUTE * share
+
+    def start(self) -> "WorkerPool":
+        queue = JobQueue(self.db_path)
+        queue.requeue_orphaned()
+        queue.prune()
+        api_limiter.configure(self._requests_per_minute, self._tokens_per_minute)
+        self.ensure_running()
+        atexit.register(self.stop)
+        return self
+
+    def ensure_running(self) -> None:
+        """
+        Replaces any worker process that has died, requeueing the job it was running.
+        """
+        with self._lock:
+            alive = [p for p in self._processes if p.poll() is None]
+            if len(alive) < len(self._processes):
+                JobQueue(self.db_path).requeue_orphaned(p.pid for p in alive)
+            while len(alive) < self.workers:
+                alive.append(subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), "--db", self.db_path],
+                    stdin=subprocess.PIPE,
+                    env=dict(
+                        os.environ,
+                        COMICVERSE_REQUESTS_PER_MINUTE=str(self._requests_per_minute),
+                        COMICVERSE_TOKENS_PER_MINUTE=str(self._tokens_per_minute),
+                    ),
+                ))
+            self._processes = alive
+
+    def stop(self, timeout: float = 5.0) -> None:
+        with self._lock:
+            for process in self._processes:
+                process.stdin.close()
+            deadline = time.monotonic() + timeout
+            for process in self._processes:
+                try:
+                    process.wait(max(0.0, deadline - time.monotonic()))
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+            self._processes = []
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Run a ComicVerse job worker (started by WorkerPool).")
+    parser.add_argument("--db", default=JOB_DB_PATH, help="Job database (default: %(default)s).")
+    parser.add_argument("--poll-interval", type=float, default=0.5, help="Seconds between queue polls when idle.")
+    args = parser.parse_args(argv)
+
+    stop = threading.Event()
+    threading.Thread(target=_stop_on_stdin_eof, args=(stop,), daemon=True).start()
+    run_worker(args.db, args.poll_interval, stop)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
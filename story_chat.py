@@ -0,0 +1,290 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Iterator, List, Optional
+
+import numpy as np
+
+from comicToStory_audio_batching import chunk_text_for_tts, iter_completion_text
+from comicverse_common import call_with_retry, openai
+
+#--------------------------------------------
+# Passage index
+#--------------------------------------------
+
+CHAT_EMBEDDING_MODEL = os.getenv("COMICVERSE_CHAT_EMBEDDING_MODEL", "text-embedding-3-small")
+CHAT_MODEL = os.getenv("COMICVERSE_CHAT_MODEL", "gpt-4o-mini")
+# Passages are page narrations and story paragraphs, packed to at most this many characters
+CHAT_PASSAGE_CHARS = 800
+# Passages sent with each question
+CHAT_TOP_K = 4
+# Inputs per embeddings request
+EMBEDDING_BATCH_SIZE = 256
+
+
+def embed_texts(texts: List[str], model: str = CHAT_EMBEDDING_MODEL) -> np.ndarray:
+    """
+    Embeds texts with the OpenAI embeddings endpoint.
+    Returns a (len(texts), dim) float32 matrix of unit-length rows.
+    """
+    vectors = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        response = call_with_retry(
+            openai.embeddings.create, model=model, input=texts[start:start + EMBEDDING_BATCH_SIZE]
+        )
+        vectors.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.maximum(norms, 1e-12)
+
+
+def story_key(story: str, narrations: List[str]) -> str:
+    """
+    Identifies one generated story (its text and page narrations), e.g. to share its index.
+    """
+    digest = hashlib.sha256(story.encode("utf-8"))
+    for narration in narrations:
+        digest.update(b"\0" + narration.encode("utf-8"))
+    return digest.hexdigest()
+
+
+class StoryIndex:
+    """
+    In-memory vector index over one story: every page narration and the final story, split into
+    passages of at most CHAT_PASSAGE_CHARS, each with a label ("Page 3", "Story part 2").
+    Built once per story; search is a dot product against the unit-length passage vectors.
+    """
+    def __init__(self, key: str, passages: List[tuple], vectors: np.ndarray, model: str = CHAT_EMBEDDING_MODEL):
+        self.key = key
+        self.passages = passages
+        self.vectors = vectors
+        self.model = model
+
+    @classmethod
+    def build(cls, story: str, narrations: List[str], model: str = CHAT_EMBEDDING_MODEL) -> "StoryIndex":
+        # chunk_text_for_tts packs whole sentences per paragraph, which also makes good passages
+        passages = []
+        for page, narration in enumerate(narrations, start=1):
+            for text in chunk_text_for_tts(narration, CHAT_PASSAGE_CHARS):
+                passages.append((f"Page {page}", text))
+        for part, text in enumerate(chunk_text_for_tts(story, CHAT_PASSAGE_CHARS), start=1):
+            passages.append((f"Story part {part}", text))
+        vectors = embed_texts([text for _, text in passages], model) if passages else np.zeros((0, 0), np.float32)
+        return cls(story_key(story, narrations), passages, vectors, model)
+
+    def embed_query(self, question: str) -> np.ndarray:
+        return embed_texts([question], self.model)[0]
+
+    def search(self, query: np.ndarray, k: int = CHAT_TOP_K) -> List[tuple]:
+        """
+        Returns the k passages most similar to the query vector as (label, text, score),
+        best first.
+        """
+        if not self.passages:
+            return []
+        scores = self.vectors @ query
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(*self.passages[i], float(scores[i])) for i in top]
+
+#--------------------------------------------
+# Answer cache
+#--------------------------------------------
+
+# Cosine similarity above which two questions about the same story count as the same question
+CHAT_CACHE_THRESHOLD = float(os.getenv("COMICVERSE_CHAT_CACHE_THRESHOLD", "0.92"))
+CHAT_CACHE_TTL_SECONDS = float(os.getenv("COMICVERSE_CHAT_CACHE_TTL_HOURS", "24")) * 3600
+CHAT_CACHE_MAX_ENTRIES = int(os.getenv("COMICVERSE_CHAT_CACHE_MAX_ENTRIES", "2048"))
+
+
+def normalize_question(question: str) -> str:
+    """
+    Case-folds a question and drops punctuation and extra whitespace,
+    so "Who is the villain?" and "who is the villain" are the same question.
+    """
+    text = unicodedata.normalize("NFKC", question).casefold()
+    text = "".join(" " if unicodedata.category(ch).startswith("P") else ch for ch in text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class AnswerCache:
+    """
+    In-memory cache of chat answers per story (StoryIndex.key), shared by every session.
+    A question hits on the same normalized text, or on an embedding whose cosine similarity to a
+    cached question of the same story is at least `threshold`. Entries expire after `ttl` seconds
+    and the least recently used are evicted beyond `max_entries`. Hit/miss counts are kept in `stats`.
+    """
+    def __init__(
+        self,
+        threshold: float = CHAT_CACHE_THRESHOLD,
+        ttl: float = CHAT_CACHE_TTL_SECONDS,
+        max_entries: int = CHAT_CACHE_MAX_ENTRIES,
+    ):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (story key, normalized question) -> (question vector, answer, created), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "semantic_hits": 0, "misses": 0, "expired": 0, "evicted": 0}
+
+    def _expired(self, created: float, now: float) -> bool:
+        return now - created > self.ttl
+
+    def get(self, story: str, question: str, query: np.ndarray) -> Optional[str]:
+        """
+        Returns the cached answer to this question (or a near-duplicate of it) about the story,
+        or None. query is the unit-length embedding of the question.
+        """
+        key = (story, normalize_question(question))
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[2], now):
+                del self._entries[key]
+                self.stats["expired"] += 1
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+
+            best_key, best_score = None, self.threshold
+            for other_key, (vector, _, created) in list(self._entries.items()):
+                if other_key[0] != story:
+                    continue
+                if self._expired(created, now):
+                    del self._entries[other_key]
+                    self.stats["expired"] += 1
+                    continue
+                score = float(vector @ query)
+                if score >= best_score:
+                    best_key, best_score = other_key, score
+            if best_key is None:
+                self.stats["misses"] += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.stats["semantic_hits"] += 1
+            return self._entries[best_key][1]
+
+    def put(self, story: str, question: str, query: np.ndarray, answer: str) -> None:
+        key = (story, normalize_question(question))
+        with self._lock:
+            self._entries[key] = (query, answer, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evicted"] += 1
+
+    def hit_rate(self) -> float:
+        with self._lock:
+            hits = self.stats["hits"] + self.stats["semantic_hits"]
+            total = hits + self.stats["misses"]
+        return hits / total if total else 0.0
+
+#--------------------------------------------
+# Chat with the story
+#--------------------------------------------
+
+# Most recent turns sent verbatim; older turns are folded into the rolling summary
+CHAT_RECENT_TURNS = 2
+CHAT_SUMMARY_MAX_TOKENS = 200
+CHAT_ANSWER_MAX_TOKENS = 300
+
+CHAT_SYSTEM_PROMPT = (
+    "You answer questions about a comic book story. Use only the passages from the comic and the "
+    "conversation so far. If the passages do not contain the answer, say so. "
+    "Answer in the language of the question."
+)
+
+
+class StoryChat:
+    """
+    One conversation about one story. Each question sends only the CHAT_TOP_K passages most
+    relevant to it, a rolling summary of older turns (at most CHAT_SUMMARY_MAX_TOKENS) and the last
+    CHAT_RECENT_TURNS turns, so the prompt stays the same size however long the comic or the
+    conversation gets.
+    With a cache, the first question of a conversation reuses the answer to the same question
+    asked about the same story before; only such first answers are stored and looked up,
+    since later ones may lean on earlier turns.
+    """
+    def __init__(
+        self,
+        index: StoryIndex,
+        cache: Optional[AnswerCache] = None,
+        top_k: int = CHAT_TOP_K,
+        recent_turns: int = CHAT_RECENT_TURNS,
+    ):
+        self.index = index
+        self.cache = cache
+        self.top_k = top_k
+        self.recent_turns = recent_turns
+        self.summary = ""
+        self.turns = []  # (question, answer), oldest first
+
+    def _messages(self, question: str, passages: List[tuple]) -> List[dict]:
+        context = "\n\n".join(f"[{label}]\n{text}" for label, text, _ in passages)
+        messages = [{"role": "system", "content": CHAT_SYSTEM_PROMPT}]
+        if self.summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{self.summary}"})
+        for asked, answered in self.turns:
+            messages.append({"role": "user", "content": asked})
+            messages.append({"role": "assistant", "content": answered})
+        messages.append({"role": "user", "content": f"Passages from the comic:\n\n{context}\n\nQuestion: {question}"})
+        return messages
+
+    def iter_answer(self, question: str, query: Optional[np.ndarray] = None) -> Iterator[str]:
+        """
+        Streams the answer to a question (query is its embedding, if already computed) and
+        records the turn once the answer is complete.
+        """
+        if query is None:
+            query = self.index.embed_query(question)
+        # Cached answers were given without any conversation, so only a first question can reuse one;
+        # a follow-up like "why did he do that?" must not match a stored first question
+        standalone = not self.turns and not self.summary
+        if self.cache is not None and standalone:
+            cached = self.cache.get(self.index.key, question, query)
+            if cached is not None:
+                yield cached
+                self.record_turn(question, cached)
+                return
+        passages = self.index.search(query, self.top_k)
+        answer = ""
+        for text in iter_completion_text(
+            self._messages(question, passages), model=CHAT_MODEL,
+            temperature=0.7, max_tokens=CHAT_ANSWER_MAX_TOKENS,
+        ):
+            answer += text
+            yield text
+        answer = answer.strip()
+        if self.cache is not None and standalone and answer:
+            self.cache.put(self.index.key, question, query, answer)
+        self.record_turn(question, answer)
+
+    def record_turn(self, question: str, answer: str) -> None:
+        self.turns.append((question, answer))
+        if len(self.turns) > self.recent_turns:
+            self._fold_into_summary(self.turns.pop(0))
+
+    def _fold_into_summary(self, turn: tuple) -> None:
+        question, answer = turn
+        prompt = "\n\n".join([
+            f"Conversation summary so far:\n{self.summary or '(empty)'}",
+            f"New exchange:\nUser: {question}\nAssistant: {answer}",
+            "Update the summary to include the new exchange. Keep names, facts and open questions; "
+            "drop small talk. At most 120 words.",
+        ])
+        response = call_with_retry(
+            openai.chat.completions.create,
+            model=CHAT_MODEL,
+            messages=[{"role": "user", "content": prompt}],
+            temperature=0.3,
+            max_tokens=CHAT_SUMMARY_MAX_TOKENS,
+        )
+        self.summary = response.choices[0].message.content.strip()
@@ -0,0 +1,35 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+from fake_openai import FakeOpenAI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# Caches, audiobooks and the job database go to a scratch directory, and every API call to the
+# fake server; set before the pipeline modules read them at import time.
+SCRATCH = tempfile.mkdtemp(prefix="comicverse-tests-")
+os.environ["COMICVERSE_CACHE_DIR"] = os.path.join(SCRATCH, "cache")
+os.environ["COMICVERSE_AUDIO_DIR"] = os.path.join(SCRATCH, "audios")
+os.environ["OPENAI_API_KEY"] = "sk-test"
+# The fake server has no rate limits; tests of the limiter build their own
+os.environ["COMICVERSE_REQUESTS_PER_MINUTE"] = "1000000"
+os.environ["COMICVERSE_TOKENS_PER_MINUTE"] = "1000000000"
+
+
+@pytest.fixture(scope="session")
+def _fake_server():
+    # One server for the whole run: the shared openai client keeps the base URL it was created with
+    server = FakeOpenAI().start()
+    os.environ["OPENAI_BASE_URL"] = server.base_url
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def fake_openai(_fake_server):
+    """The fake OpenAI server, reset for this test; call .reset(...) to inject latency or 429s."""
+    return _fake_server.reset()
@@ -0,0 +1,189 @@
+"""
+Local stand-in for the OpenAI HTTP API, so the pipeline can be exercised without a key or network:
+start it and point OPENAI_BASE_URL at its base_url.
+
+Serves chat completions (plain, structured and streamed), /audio/speech and /embeddings, with
+configurable latency, 429 responses and pages left out of structured narration replies.
+"""
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def fake_mp3(text: str) -> bytes:
+    """
+    What /audio/speech returns for text: an ID3v2 tag, "[text]" as the audio frames, an ID3v1 tag.
+    """
+    id3v2 = b"ID3\x04\x00\x00\x00\x00\x00\x04tags"
+    id3v1 = b"TAG" + b"\x00" * 125
+    return id3v2 + f"[{text}]".encode("utf-8") + id3v1
+
+
+def fake_embedding(text: str, dim: int = 32) -> list:
+    # Bag of words hashed into dim buckets: texts sharing words are similar
+    vector = [0.0] * dim
+    for word in re.findall(r"\w+", text.lower()):
+        vector[sum(word.encode("utf-8")) % dim] += 1.0
+    return vector
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        fake = self.server.fake
+        body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+        with fake.lock:
+            fake.requests.append((self.path, body))
+            limited = fake.rate_limited < fake.rate_limit_first
+            if limited:
+                fake.rate_limited += 1
+            fake.in_flight += 1
+            fake.max_in_flight = max(fake.max_in_flight, fake.in_flight)
+        try:
+            time.sleep(fake.latency)
+            if limited:
+                headers = {"retry-after-ms": str(fake.retry_after_ms)} if fake.retry_after_ms is not None else {}
+                self._send_json({"error": {"message": "Rate limit reached", "type": "requests"}}, 429, headers)
+            elif any(self.path.endswith(suffix) for suffix in fake.reject):
+                self._send_json({"error": {"message": "Rejected by the fake server", "type": "invalid_request_error"}}, 400)
+            elif self.path.endswith("/audio/speech"):
+                self._send(fake_mp3(body["input"]), "audio/mpeg")
+            elif self.path.endswith("/embeddings"):
+                inputs = [body["input"]] if isinstance(body["input"], str) else body["input"]
+                self._send_json({
+                    "object": "list",
+                    "model": body["model"],
+                    "data": [
+                        {"object": "embedding", "index": i, "embedding": fake_embedding(text)}
+                        for i, text in enumerate(inputs)
+                    ],
+                    "usage": {"prompt_tokens": 0, "total_tokens": 0},
+                })
+            else:
+                self._chat(body)
+        finally:
+            with fake.lock:
+                fake.in_flight -= 1
+
+    def _chat(self, body: dict):
+        fake = self.server.fake
+        content = body["messages"][-1]["content"]
+        parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+        # Each page is an image followed by its optional "OCR for Page N:" text
+        pages = []
+        for part in parts:
+            if part["type"] == "image_url":
+                pages.append("")
+            elif pages and part["text"].startswith("OCR for Page"):
+                pages[-1] = part["text"].split("\n", 1)[1]
+        if body.get("response_format"):
+            skipped = fake.skip_pages if len(pages) > 1 else set()
+            text = json.dumps({"pages": [
+                {"page_index": i, "narration": f"Narration of {ocr or f'image {i}'}"}
+                for i, ocr in enumerate(pages, start=1) if i not in skipped
+            ]})
+        elif pages:
+            text = "\n".join(f"Page {i}: Narration of {ocr or f'image {i}'}" for i, ocr in enumerate(pages, start=1))
+        else:
+            text = fake.reply
+        if body.get("stream"):
+            self.send_response(200)
+            self.send_header("content-type", "text/event-stream")
+            self.end_headers()
+            for word in re.findall(r"\S+\s*", text):
+                chunk = {
+                    "id": "chatcmpl-fake", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                    "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}],
+                }
+                self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.write(b"data: [DONE]\n\n")
+            return
+        self._send_json({
+            "id": "chatcmpl-fake", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    def _send_json(self, payload: dict, status: int = 200, headers: dict = None):
+        self._send(json.dumps(payload).encode("utf-8"), "application/json", status, headers)
+
+    def _send(self, data: bytes, content_type: str, status: int = 200, headers: dict = None):
+        self.send_response(status)
+        self.send_header("content-type", content_type)
+        self.send_header("content-length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class FakeOpenAI:
+    """
+    The fake API server. Configure it per test with reset(); `requests` records (path, body)
+    of every request and max_in_flight the most requests it was serving at once.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._server = None
+        self.reset()
+
+    def reset(
+        self,
+        latency: float = 0.0,
+        rate_limit_first: int = 0,
+        retry_after_ms: int = None,
+        skip_pages=(),
+        reply: str = "Once upon a time.",
+        reject=(),
+    ) -> "FakeOpenAI":
+        """
+        latency: seconds before each response. rate_limit_first: answer that many requests with 429
+        (with a retry-after-ms header if retry_after_ms is set). skip_pages: 1-based positions left out
+        of structured replies to multi-page requests. reply: text of non-narration completions.
+        reject: path suffixes (e.g. "/embeddings") answered with 400 Bad Request.
+        """
+        with self.lock:
+            self.latency = latency
+            self.rate_limit_first = rate_limit_first
+            self.retry_after_ms = retry_after_ms
+            self.skip_pages = set(skip_pages)
+            self.reply = reply
+            self.reject = tuple(reject)
+            self.requests = []
+            self.rate_limited = 0
+            self.in_flight = 0
+            self.max_in_flight = 0
+        return self
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def paths(self, suffix: str) -> list:
+        """Bodies of the requests whose path ends with suffix."""
+        return [body for path, body in self.requests if path.endswith(suffix)]
+
+    def start(self) -> "FakeOpenAI":
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.fake = self
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == "__main__":
+    server = FakeOpenAI().start()
+    print(f"Fake OpenAI API at {server.base_url} (Ctrl+C to stop)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,55 @@
+import os
+
+from streamlit.testing.v1 import AppTest
+
+from conftest import ROOT
+
+STORY = "Mira climbs the old clock tower at night. Doctor Zed, the villain, waits for her at the top."
+NARRATIONS = ["Mira climbs the clock tower.", "Doctor Zed waits at the top of the tower."]
+
+
+def open_chat(story: str) -> AppTest:
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=30)
+    at.session_state["story"] = story
+    at.session_state["page_narrations"] = NARRATIONS
+    at.run()
+    return at
+
+
+def ask(at: AppTest, question: str) -> None:
+    at.text_input(key="chat_input").set_value(question).run()
+    at.button(key="send_btn").click().run()
+
+
+def test_story_is_indexed_on_the_first_question_not_on_render(fake_openai):
+    fake_openai.reset(reply="Doctor Zed is the villain.")
+    at = open_chat(STORY)
+    assert not at.exception
+    assert fake_openai.paths("/embeddings") == []
+
+    ask(at, "Who is the villain?")
+    assert not at.exception
+    assert not at.error
+    assert fake_openai.paths("/embeddings")
+    assert at.session_state["chat_history"] == [
+        {"role": "user", "content": "Who is the villain?"},
+        {"role": "ai", "content": "Doctor Zed is the villain."},
+    ]
+
+
+def test_chat_failure_is_shown_in_the_chat_area(fake_openai):
+    fake_openai.reset(reject=["/embeddings"])
+    at = open_chat(STORY + " A different night.")
+    ask(at, "Who is the villain?")
+
+    assert not at.exception
+    assert len(at.error) == 1
+    assert "Could not answer the question" in at.error[0].value
+    assert at.session_state["chat_history"] == []
+    # The rest of the page still renders
+    assert any(header.value == ":book: Extracted Story:" for header in at.subheader)
+
+    fake_openai.reset(reply="Doctor Zed.")
+    ask(at, "Who is the villain?")
+    assert not at.error
+    assert at.session_state["chat_history"][-1] == {"role": "ai", "content": "Doctor Zed."}
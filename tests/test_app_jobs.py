@@ -0,0 +1,32 @@
+import os
+
+from streamlit.testing.v1 import AppTest
+
+from comicToStory_audio_batching import AUDIO_DIR
+from conftest import ROOT
+from job_queue import JobQueue
+
+
+def test_audiobook_job_submitted_from_the_app_is_done_by_a_worker(fake_openai):
+    at = AppTest.from_file(os.path.join(ROOT, "app.py"), default_timeout=30)
+    at.session_state["story"] = "Mira climbs the tower. Doctor Zed is waiting at the top."
+    at.session_state["page_narrations"] = ["Mira climbs the tower.", "Doctor Zed waits."]
+    at.run()
+    at.file_uploader[0].set_value(("comic.pdf", b"%PDF-1.4 not rendered for an audiobook", "application/pdf"))
+    at.run()
+    assert not at.exception
+
+    # The click queues the job and the page reruns every POLL_INTERVAL until a worker process
+    # has picked it up and finished it
+    next(button for button in at.button if button.label == "Generate Audiobook").click().run(timeout=60)
+    assert not at.exception
+    assert at.session_state["job_id"] is None
+    audio_rel = at.session_state["audio_rel"]
+    assert audio_rel is not None
+    assert os.path.exists(os.path.join(AUDIO_DIR, os.path.basename(audio_rel)))
+    assert [body["input"] for body in fake_openai.paths("/audio/speech")] == [at.session_state["story"]]
+
+    # Submitting the same audiobook again reuses the finished job
+    job = JobQueue().get(JobQueue().submit_audio(at.session_state["story"], voice="alloy"))
+    assert job["status"] == "done"
+    assert job["result"]["audio_rel"] == audio_rel
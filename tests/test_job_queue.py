@@ -0,0 +1,134 @@
+import os
+import time
+
+import pytest
+
+from comicToStory_audio_batching import AUDIO_DIR
+from comicverse_common import REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE
+from job_queue import JobQueue, WorkerPool, _Progress, _run_audio_job
+
+
+def make_queue(tmp_path) -> JobQueue:
+    return JobQueue(str(tmp_path / "jobs.sqlite"))
+
+
+def test_identical_active_jobs_are_deduplicated(tmp_path):
+    queue = make_queue(tmp_path)
+    job_id = queue.submit_story(b"%PDF", "Fun", "English")
+    assert queue.submit_story(b"%PDF", "Fun", "English") == job_id
+    assert queue.submit_story(b"%PDF", "Dramatic", "English") != job_id
+
+    queue.claim(os.getpid())
+    assert queue.submit_story(b"%PDF", "Fun", "English") == job_id
+
+
+def test_done_job_is_reused_only_while_its_audiobook_exists(tmp_path):
+    queue = make_queue(tmp_path)
+    os.makedirs(AUDIO_DIR, exist_ok=True)
+    audio_path = os.path.join(AUDIO_DIR, "dedup-test.mp3")
+    with open(audio_path, "wb") as f:
+        f.write(b"mp3")
+    job_id = queue.submit_audio("Some story.")
+    queue.claim(os.getpid())
+    queue.finish(job_id, {"audio_rel": "audios/dedup-test.mp3"})
+    assert queue.submit_audio("Some story.") == job_id
+
+    os.remove(audio_path)
+    assert queue.submit_audio("Some story.") != job_id
+
+
+def test_failed_and_cancelled_jobs_are_not_reused(tmp_path):
+    queue = make_queue(tmp_path)
+    failed = queue.submit_audio("Failing story.")
+    queue.claim(os.getpid())
+    queue.fail(failed, "RuntimeError: boom")
+    cancelled = queue.submit_audio("Cancelled story.")
+    queue.cancel(cancelled)
+
+    assert queue.submit_audio("Failing story.") != failed
+    assert queue.submit_audio("Cancelled story.") != cancelled
+
+
+def test_requeue_orphaned_keeps_jobs_of_live_workers(tmp_path):
+    queue = make_queue(tmp_path)
+    first = queue.submit_audio("First.")
+    second = queue.submit_audio("Second.")
+    queue.claim(111)
+    queue.claim(222)
+
+    assert queue.requeue_orphaned(live_pids=[222]) == 1
+    assert queue.get(first)["status"] == "queued"
+    assert queue.get(first)["worker_pid"] is None
+    assert queue.get(second)["status"] == "running"
+
+
+def test_prune_deletes_old_finished_jobs_and_stray_inputs(tmp_path):
+    queue = make_queue(tmp_path)
+    old = queue.submit_story(b"%PDF old", "Fun", "English")
+    queue.claim(os.getpid())
+    queue.fail(old, "RuntimeError: boom")
+    waiting = queue.submit_story(b"%PDF waiting", "Fun", "English")
+    stray = os.path.join(queue.input_dir, "stray.bin")
+    with open(stray, "wb") as f:
+        f.write(b"left over")
+    an_hour_ago = time.time() - 3600
+    os.utime(stray, (an_hour_ago, an_hour_ago))
+    time.sleep(0.01)
+
+    assert queue.prune(max_age=0) == 1
+    assert queue.get(old) is None
+    assert not os.path.exists(stray)
+    assert queue.get(waiting)["status"] == "queued"
+    assert os.path.exists(queue.get(waiting)["input_path"])
+
+
+def test_shared_job_is_cancelled_only_by_its_last_waiter(tmp_path):
+    queue = make_queue(tmp_path)
+    job_id = queue.submit_story(b"%PDF shared", "Fun", "English", waiter="session-a")
+    assert queue.submit_story(b"%PDF shared", "Fun", "English", waiter="session-b") == job_id
+    queue.claim(os.getpid())
+
+    assert not queue.cancel(job_id, waiter="session-a")
+    assert not queue.cancel_requested(job_id)
+    assert queue.cancel(job_id, waiter="session-b")
+    assert queue.cancel_requested(job_id)
+
+
+def test_job_being_cancelled_is_not_shared(tmp_path):
+    queue = make_queue(tmp_path)
+    job_id = queue.submit_story(b"%PDF", "Fun", "English", waiter="session-a")
+    queue.claim(os.getpid())
+    assert queue.cancel(job_id, waiter="session-a")
+
+    new_id = queue.submit_story(b"%PDF", "Fun", "English", waiter="session-b")
+    assert new_id != job_id
+    assert queue.get(new_id)["status"] == "queued"
+
+
+def test_audio_job_publishes_the_partial_audiobook(fake_openai, tmp_path):
+    queue = make_queue(tmp_path)
+    text = " ".join(f"Streaming sentence number {i}." for i in range(120))  # several TTS chunks
+    job = queue.get(queue.submit_audio(text))
+    published = []
+    update = queue.update
+
+    def record_update(job_id, progress=None, partial=None, partial_audio=None):
+        if partial_audio:
+            published.append(partial_audio)
+        update(job_id, progress, partial, partial_audio)
+
+    queue.update = record_update
+    result = _run_audio_job(job, _Progress(queue, job["id"]))
+
+    assert len(published) > 1
+    assert len(set(published)) == 1
+    assert published[0].startswith("audios/") and published[0].endswith(".partial.mp3")
+    assert queue.get(job["id"])["partial_audio"] == published[0]
+    queue.finish(job["id"], result)
+    assert queue.get(job["id"])["partial_audio"] is None
+
+
+def test_worker_pool_splits_the_rate_limit_between_processes(tmp_path):
+    pool = WorkerPool(workers=2, db_path=str(tmp_path / "jobs.sqlite"))
+    assert pool._requests_per_minute * 3 == pytest.approx(REQUESTS_PER_MINUTE)
+    assert pool._tokens_per_minute * 3 == pytest.approx(TOKENS_PER_MINUTE)
@@ -0,0 +1,106 @@
+import io
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+import comicverse_common
+from comicToStory_audio_batching import NarrationScheduler
+from comicverse_common import RateLimiter, TokenBucket, call_with_retry, get_retry_stats, openai
+
+
+def page_jpeg(shade: int = 128) -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (32, 48), (shade, shade, shade)).save(buffer, format="JPEG")
+    return buffer.getvalue()
+
+
+def test_token_bucket_spends_capacity_then_refills_at_rate():
+    bucket = TokenBucket(per_minute=600, capacity=5)  # 10 tokens/s
+    assert [bucket.reserve() for _ in range(5)] == [0.0] * 5
+    waits = [bucket.reserve() for _ in range(3)]
+    assert waits == sorted(waits)
+    assert waits[0] == pytest.approx(0.1, abs=0.02)
+    assert waits[-1] == pytest.approx(0.3, abs=0.02)
+
+
+def test_token_bucket_caps_oversized_requests_at_capacity():
+    bucket = TokenBucket(per_minute=60, capacity=10)
+    assert bucket.reserve(50) == 0.0
+    assert bucket.reserve(1) == pytest.approx(1.0, abs=0.05)
+
+
+def test_token_bucket_is_shared_safely_between_threads():
+    bucket = TokenBucket(per_minute=60, capacity=10)
+    waits = []
+    threads = [threading.Thread(target=lambda: waits.append(bucket.reserve())) for _ in range(30)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 10 from the full bucket, then one more per second: every reservation gets its own slot
+    assert sorted(round(wait) for wait in waits) == [0] * 10 + list(range(1, 21))
+
+
+def test_schedulers_and_retry_layer_share_one_rate_limit(fake_openai, monkeypatch):
+    limiter = RateLimiter(requests_per_minute=600, tokens_per_minute=10**9)  # 10 requests/s
+    limiter.requests.tokens = 0
+    monkeypatch.setattr(comicverse_common, "api_limiter", limiter)
+    start = time.monotonic()
+    with NarrationScheduler(limiter=limiter) as first, NarrationScheduler(limiter=limiter) as second:
+        futures = [scheduler.submit([i], [page_jpeg()], [f"page {i}"]) for i, scheduler in enumerate([first, second] * 2)]
+        for _ in range(2):
+            call_with_retry(openai.embeddings.create, model="text-embedding-3-small", input="hello")
+        NarrationScheduler.collect(futures)
+    # 6 requests from two schedulers and the retry layer, at 10/s from an empty bucket
+    assert time.monotonic() - start >= 0.55
+    assert len(fake_openai.requests) == 6
+
+
+def test_scheduler_caps_concurrent_requests(fake_openai):
+    fake_openai.reset(latency=0.2)
+    with NarrationScheduler(max_concurrency=2) as scheduler:
+        futures = [scheduler.submit([i], [page_jpeg()], [f"page {i}"]) for i in range(6)]
+        narrations = scheduler.collect(futures)
+    assert fake_openai.max_in_flight == 2
+    assert narrations == {i: f"Narration of page {i}" for i in range(6)}
+
+
+def test_scheduler_waits_for_retry_after_ms_on_429(fake_openai):
+    fake_openai.reset(rate_limit_first=2, retry_after_ms=300)
+    before = get_retry_stats()
+    start = time.monotonic()
+    with NarrationScheduler() as scheduler:
+        narrations = scheduler.collect([scheduler.submit([0], [page_jpeg()], ["hello"])])
+    elapsed = time.monotonic() - start
+    after = get_retry_stats()
+
+    assert narrations == {0: "Narration of hello"}
+    assert len(fake_openai.paths("/chat/completions")) == 3
+    assert elapsed >= 0.6
+    assert after["retries"] - before["retries"] == 2
+    assert after["backoff_seconds"] - before["backoff_seconds"] == pytest.approx(0.6)
+
+
+def test_scheduler_rerequests_only_skipped_pages(fake_openai):
+    fake_openai.reset(skip_pages={2, 4})
+    ocr = ["alpha", "beta", "gamma", "delta"]
+    with NarrationScheduler() as scheduler:
+        images = [page_jpeg(40 * i) for i in range(4)]
+        narrations = scheduler.collect([scheduler.submit([10, 11, 12, 13], images, ocr)])
+
+    assert narrations == {10 + i: f"Narration of {text}" for i, text in enumerate(ocr)}
+    requests = fake_openai.paths("/chat/completions")
+    image_counts = sorted(
+        sum(part["type"] == "image_url" for part in body["messages"][-1]["content"]) for body in requests
+    )
+    assert image_counts == [1, 1, 4]
+    assert all(body["response_format"]["json_schema"]["name"] == "page_narrations" for body in requests)
+
+
+def test_scheduler_unstructured_mode_parses_page_labels(fake_openai):
+    with NarrationScheduler(structured=False) as scheduler:
+        narrations = scheduler.collect([scheduler.submit([5, 6], [page_jpeg(), page_jpeg(200)], ["one", "two"])])
+    assert narrations == {5: "Narration of one", 6: "Narration of two"}
+    assert "response_format" not in fake_openai.paths("/chat/completions")[0]
@@ -0,0 +1,90 @@
+import threading
+import time
+
+import pytest
+
+import comicverse_common
+from comicToStory_audio_batching import NarrationScheduler
+from comicverse_common import CircuitBreaker, CircuitOpenError, call_with_retry, get_retry_stats
+
+
+def open_breaker(cooldown: float = 0.1) -> CircuitBreaker:
+    breaker = CircuitBreaker(threshold=2, cooldown=cooldown)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def test_breaker_opens_after_threshold_failures():
+    breaker = CircuitBreaker(threshold=2, cooldown=60)
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+
+def test_breaker_lets_one_trial_call_through_after_cooldown():
+    breaker = open_breaker()
+    time.sleep(0.15)
+    admitted, rejected = [], []
+
+    def call():
+        try:
+            breaker.check()
+            admitted.append(1)
+        except CircuitOpenError:
+            rejected.append(1)
+
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(admitted) == 1
+    assert len(rejected) == 7
+
+
+def test_breaker_trial_success_closes_and_failure_reopens():
+    breaker = open_breaker()
+    time.sleep(0.15)
+    breaker.check()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    time.sleep(0.15)
+    breaker.check()
+    breaker.record_success()
+    breaker.check()
+    breaker.check()
+
+
+def test_breaker_replaces_a_trial_that_never_reports():
+    breaker = open_breaker()
+    time.sleep(0.15)
+    breaker.check()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    time.sleep(0.15)
+    breaker.check()
+
+
+@pytest.fixture
+def opened_api_breaker(monkeypatch):
+    monkeypatch.setattr(comicverse_common.api_breaker, "opened_at", time.monotonic())
+    monkeypatch.setattr(comicverse_common.api_breaker, "trial_started", None)
+
+
+def test_rejected_calls_are_counted(fake_openai, opened_api_breaker):
+    before = get_retry_stats()
+    with pytest.raises(CircuitOpenError):
+        call_with_retry(lambda **kwargs: None)
+    with NarrationScheduler() as scheduler:
+        future = scheduler.submit([0], [b"\xff\xd8not a real jpeg"], ["text"])
+        with pytest.raises(CircuitOpenError):
+            future.result()
+    after = get_retry_stats()
+    assert after["rejected"] - before["rejected"] == 2
+    assert after["calls"] == before["calls"]
+    assert fake_openai.requests == []
@@ -0,0 +1,82 @@
+import time
+
+import numpy as np
+
+from story_chat import AnswerCache, StoryChat, StoryIndex, normalize_question
+
+STORY = "Mira climbs the old clock tower at night. Doctor Zed, the villain, waits for her at the top."
+NARRATIONS = ["Mira climbs the clock tower.", "Doctor Zed waits at the top of the tower."]
+
+
+def unit(*values) -> np.ndarray:
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_normalize_question_ignores_case_punctuation_and_spacing():
+    assert normalize_question("  Who is   the VILLAIN?! ") == "who is the villain"
+    assert normalize_question("Who's the villain?") == normalize_question("who s the villain")
+
+
+def test_cache_hits_on_normalized_text():
+    cache = AnswerCache()
+    cache.put("story", "Who is the villain?", unit(1, 0), "Doctor Zed.")
+    assert cache.get("story", "who is the villain", unit(0, 1)) == "Doctor Zed."
+    assert cache.get("other story", "Who is the villain?", unit(1, 0)) is None
+    assert cache.stats["hits"] == 1
+    assert cache.stats["misses"] == 1
+
+
+def test_cache_semantic_hit_needs_the_threshold():
+    cache = AnswerCache(threshold=0.9)
+    cache.put("story", "Who is the villain?", unit(1, 0), "Doctor Zed.")
+    assert cache.get("story", "Who is the bad guy?", unit(1, 0.2)) == "Doctor Zed."  # cosine ~0.98
+    assert cache.get("story", "Where is the tower?", unit(1, 1)) is None  # cosine ~0.71
+    assert cache.stats["semantic_hits"] == 1
+    assert cache.hit_rate() == 0.5
+
+
+def test_cache_entries_expire():
+    cache = AnswerCache(ttl=0.05)
+    cache.put("story", "Who is the villain?", unit(1, 0), "Doctor Zed.")
+    time.sleep(0.1)
+    assert cache.get("story", "Who is the villain?", unit(1, 0)) is None
+    assert cache.stats["expired"] == 1
+
+
+def test_cache_evicts_least_recently_used():
+    cache = AnswerCache(max_entries=2)
+    cache.put("story", "first", unit(1, 0, 0), "1")
+    cache.put("story", "second", unit(0, 1, 0), "2")
+    assert cache.get("story", "first", unit(1, 0, 0)) == "1"
+    cache.put("story", "third", unit(0, 0, 1), "3")
+    assert cache.get("story", "second", unit(0, 1, 0)) is None
+    assert cache.get("story", "first", unit(1, 0, 0)) == "1"
+    assert cache.stats["evicted"] == 1
+
+
+def test_first_questions_reuse_cached_answers(fake_openai):
+    fake_openai.reset(reply="Doctor Zed is the villain.")
+    index = StoryIndex.build(STORY, NARRATIONS)
+    cache = AnswerCache()
+    assert "".join(StoryChat(index, cache).iter_answer("Who is the villain?")) == "Doctor Zed is the villain."
+
+    fake_openai.reset(reply="A different answer.")
+    assert "".join(StoryChat(index, cache).iter_answer("who is the villain")) == "Doctor Zed is the villain."
+    assert fake_openai.paths("/chat/completions") == []
+
+
+def test_follow_up_questions_skip_the_cache(fake_openai):
+    fake_openai.reset(reply="Doctor Zed is the villain.")
+    index = StoryIndex.build(STORY, NARRATIONS)
+    cache = AnswerCache(threshold=0.0)  # any question about the story would match
+    "".join(StoryChat(index, cache).iter_answer("Who is the villain?"))
+
+    chat = StoryChat(index, cache)
+    assert "".join(chat.iter_answer("What happens at the tower?")) == "Doctor Zed is the villain."
+    fake_openai.reset(reply="To stop Doctor Zed.")
+    assert "".join(chat.iter_answer("Why did she do that?")) == "To stop Doctor Zed."
+    # The follow-up was answered with the earlier turn as context, and its answer was not cached
+    messages = fake_openai.paths("/chat/completions")[0]["messages"]
+    assert {"role": "assistant", "content": "Doctor Zed is the villain."} in messages
+    assert len(cache._entries) == 1
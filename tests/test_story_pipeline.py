@@ -0,0 +1,122 @@
+import io
+
+import pytest
+from PIL import Image
+
+import comicToStory_audio_batching as pipeline
+from comicToStory_audio_batching import ComicPage
+
+
+def comic_pages(n_pages: int, title: str = "comic") -> list:
+    pages = []
+    for index in range(n_pages):
+        buffer = io.BytesIO()
+        Image.new("RGB", (32, 48), (index * 7 % 256, 80, 160)).save(buffer, format="JPEG")
+        pages.append((ComicPage(index, buffer.getvalue(), 32, 48), f"{title} page {index + 1}"))
+    return pages
+
+
+@pytest.fixture
+def rendered_comic(monkeypatch):
+    """Replaces rendering and OCR (poppler, tesseract) with n_pages generated pages."""
+    def use(n_pages: int, title: str = "comic") -> list:
+        pages = comic_pages(n_pages, title)
+        monkeypatch.setattr(pipeline, "iter_ocr_pages", lambda *args, **kwargs: iter(pages))
+        return pages
+    return use
+
+
+def test_batch_events_count_every_submitted_batch(fake_openai, rendered_comic, tmp_path):
+    rendered_comic(27)
+    events = list(pipeline.iter_process_entire_comic("comic.pdf", str(tmp_path), use_cache=False))
+
+    batches = [event.data for event in events if event.kind == "batch"]
+    assert [batch["batch"] for batch in batches] == list(range(1, len(batches) + 1))
+    assert len(batches) == 3
+    assert batches[-1]["submitted"] == 3
+    assert all(batch["batch"] <= batch["submitted"] for batch in batches)
+    assert sorted(page for batch in batches for page in batch["pages"]) == list(range(1, 28))
+    narrations = next(event.data for event in events if event.kind == "narrations")
+    assert narrations == [f"Narration of comic page {i}" for i in range(1, 28)]
+
+
+def test_finished_batches_are_cached_when_the_job_stops_early(fake_openai, rendered_comic, tmp_path):
+    rendered_comic(25, title="cancelled comic")
+    events = pipeline.iter_process_entire_comic("comic.pdf", str(tmp_path))
+    first_batch = next(event.data["pages"] for event in events if event.kind == "batch")
+    events.close()  # e.g. the job was cancelled
+
+    fake_openai.reset()
+    events = list(pipeline.iter_process_entire_comic("comic.pdf", str(tmp_path)))
+    cached = [event.data["page"] for event in events if event.kind == "page" and event.data["cached"]]
+    assert set(first_batch) <= set(cached)
+    narrated = [
+        body for body in fake_openai.paths("/chat/completions") if "response_format" in body
+    ]
+    assert sum(
+        part["type"] == "image_url" for body in narrated for part in body["messages"][-1]["content"]
+    ) == 25 - len(cached)
+
+
+def narrations(n_pages: int) -> list:
+    return [f"Narration of page {i}: the heroes cross the city and argue about the plan." for i in range(1, n_pages + 1)]
+
+
+def synopsis_requests(fake_openai) -> list:
+    return [
+        body for body in fake_openai.paths("/chat/completions")
+        if "chapter synopsis" in body["messages"][-1]["content"]
+    ]
+
+
+def test_ordinary_issue_skips_the_reduce(fake_openai):
+    sections = pipeline.reduce_to_sections(narrations(32))
+    assert sections == [(i, i, text) for i, text in enumerate(narrations(32), start=1)]
+    assert fake_openai.requests == []
+
+
+def test_reduce_splits_levels_into_near_equal_groups(fake_openai):
+    fake_openai.reset(reply="Synopsis.")
+    pages = narrations(145)
+    sections = pipeline.reduce_to_sections(pages, fan_in=12, max_prompt_tokens=1000)
+
+    assert len(synopsis_requests(fake_openai)) == 13
+    sizes = [last - first + 1 for first, last, _ in sections]
+    assert len(sections) == 13
+    assert max(sizes) - min(sizes) <= 1
+    assert [first for first, _, _ in sections] == [1] + [last + 1 for _, last, _ in sections[:-1]]
+    assert sections[-1][1] == 145
+    assert pipeline.estimate_sections_tokens(sections) <= 1000
+
+
+def test_reduce_never_leaves_a_lone_section(fake_openai):
+    fake_openai.reset(reply="Synopsis.")
+    sections = pipeline.reduce_to_sections(narrations(13), fan_in=12, max_prompt_tokens=100)
+    assert [(first, last) for first, last, _ in sections] == [(1, 7), (8, 13)]
+
+
+def test_reduce_repeats_levels_until_the_sections_fit(fake_openai):
+    fake_openai.reset(reply="A fairly long chapter synopsis that keeps every plot event in order. " * 3)
+    sections = pipeline.reduce_to_sections(narrations(40), fan_in=4, max_prompt_tokens=300)
+    assert pipeline.estimate_sections_tokens(sections) <= 300
+    assert sections[0][0] == 1 and sections[-1][1] == 40
+    # 10 synopses of 4 pages, then 3 of those (4 + 3 + 3)
+    assert len(synopsis_requests(fake_openai)) == 13
+    assert [(first, last) for first, last, _ in sections] == [(1, 16), (17, 28), (29, 40)]
+
+
+def test_synopses_are_cached_across_styles(fake_openai, tmp_path):
+    fake_openai.reset(reply="Synopsis.")
+    cache = pipeline.NarrationCache(str(tmp_path / "narrations.sqlite"))
+    first = pipeline.reduce_to_sections(narrations(30), max_prompt_tokens=200, cache=cache)
+    requests = len(synopsis_requests(fake_openai))
+    assert requests > 0
+
+    fake_openai.reset(reply="A different synopsis.")
+    assert pipeline.reduce_to_sections(narrations(30), max_prompt_tokens=200, cache=cache) == first
+    assert synopsis_requests(fake_openai) == []
+
+
+def test_reduce_rejects_fan_in_below_two():
+    with pytest.raises(ValueError):
+        pipeline.reduce_to_sections(narrations(3), fan_in=1)
@@ -0,0 +1,109 @@
+import os
+
+import pytest
+
+from comicToStory_audio_batching import AUDIO_DIR, chunk_text_for_tts, generate_speech, strip_id3
+from fake_openai import fake_mp3
+
+ID3V2 = b"ID3\x04\x00\x00\x00\x00\x00\x04tags"
+ID3V1 = b"TAG" + b"\x00" * 125
+
+
+def test_chunks_pack_whole_sentences():
+    text = "One two. Three four! Five six? Seven eight."
+    assert chunk_text_for_tts(text, max_chars=22) == ["One two. Three four!", "Five six? Seven eight."]
+    assert chunk_text_for_tts(text, max_chars=1000) == [text]
+
+
+def test_chunks_break_at_paragraphs_and_collapse_whitespace():
+    text = "First  paragraph\nwraps here.\n\n  \nSecond paragraph."
+    assert chunk_text_for_tts(text, max_chars=1000) == ["First paragraph wraps here.", "Second paragraph."]
+
+
+def test_chunks_keep_closing_quotes_with_their_sentence():
+    text = 'He said "Run!" She ran away.'
+    assert chunk_text_for_tts(text, max_chars=20) == ['He said "Run!"', "She ran away."]
+
+
+def test_chunks_split_devanagari_sentences():
+    text = "राम घर गया। सीता बाज़ार गई।"
+    assert chunk_text_for_tts(text, max_chars=15) == ["राम घर गया।", "सीता बाज़ार गई।"]
+
+
+def test_long_sentence_is_split_at_spaces():
+    sentence = " ".join(["word"] * 30) + "."
+    chunks = chunk_text_for_tts("Short one. " + sentence, max_chars=50)
+    assert chunks[0] == "Short one."
+    assert all(len(chunk) <= 50 for chunk in chunks)
+    assert " ".join(chunks[1:]) == sentence
+
+
+def test_strip_id3_removes_tags():
+    frames = b"\xff\xfbframes"
+    assert strip_id3(ID3V2 + frames + ID3V1) == frames
+    assert strip_id3(ID3V2 + frames + ID3V1, keep_header=True) == ID3V2 + frames
+    assert strip_id3(frames) == frames
+
+
+def test_strip_id3_skips_footer_when_flagged():
+    header = b"ID3\x04\x00\x10\x00\x00\x00\x04tags"
+    assert strip_id3(header + b"3DI\x04\x00\x10\x00\x00\x00\x04" + b"frames") == b"frames"
+
+
+def test_strip_id3_reads_syncsafe_size():
+    payload = b"x" * 200  # 200 = 0b1_1001000 -> syncsafe bytes 0x01 0x48
+    assert strip_id3(b"ID3\x04\x00\x00\x00\x00\x01\x48" + payload + b"frames") == b"frames"
+
+
+def read_book(audio_rel: str) -> bytes:
+    with open(os.path.join(AUDIO_DIR, os.path.basename(audio_rel)), "rb") as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_generate_speech_concatenates_chunks_in_order(fake_openai, use_cache):
+    fake_openai.reset(latency=0.05)
+    sentences = [f"Sentence number {i} of the {'cached' if use_cache else 'plain'} book." for i in range(12)]
+    text = " ".join(sentences)
+
+    audio_rel = generate_speech(text, max_chars=60, max_workers=4, use_cache=use_cache)
+
+    chunks = chunk_text_for_tts(text, max_chars=60)
+    assert len(chunks) > 4
+    assert audio_rel.startswith("audios/")
+    # One ID3v2 header up front, then each chunk's frames in order, no ID3v1 tags
+    assert read_book(audio_rel) == ID3V2 + b"".join(f"[{chunk}]".encode("utf-8") for chunk in chunks)
+    assert sorted(body["input"] for body in fake_openai.paths("/audio/speech")) == sorted(chunks)
+    assert not [name for name in os.listdir(AUDIO_DIR) if name.endswith(".partial.mp3")]
+
+
+def test_generate_speech_reuses_cached_book_and_chunks(fake_openai):
+    text = "A cached book. It has two chunks."
+    first = generate_speech(text, max_chars=20)
+    assert len(fake_openai.paths("/audio/speech")) == 2
+
+    assert generate_speech(text, max_chars=20) == first
+    assert len(fake_openai.paths("/audio/speech")) == 2
+
+    # Editing one paragraph only synthesizes that paragraph again
+    edited = generate_speech(text + "\n\nA new ending.", max_chars=20)
+    assert edited != first
+    assert [body["input"] for body in fake_openai.paths("/audio/speech")][2:] == ["A new ending."]
+    assert read_book(edited) == fake_mp3("A cached book.")[:-128] + b"[It has two chunks.][A new ending.]"
+
+
+def test_generate_speech_exposes_each_in_order_prefix(fake_openai):
+    text = " ".join(f"Progressive sentence {i}." for i in range(6))
+    chunks = chunk_text_for_tts(text, max_chars=50)
+    prefixes = []
+
+    def on_progress(partial_rel, done, total):
+        prefixes.append((done, total, read_book(partial_rel)))
+
+    audio_rel = generate_speech(text, max_chars=50, use_cache=False, on_progress=on_progress)
+
+    assert [(done, total) for done, total, _ in prefixes] == [(i, len(chunks)) for i in range(1, len(chunks) + 1)]
+    for done, _, data in prefixes:
+        assert data == ID3V2 + b"".join(f"[{chunk}]".encode("utf-8") for chunk in chunks[:done])
+    assert read_book(audio_rel) == prefixes[-1][2]
+    assert not [name for name in os.listdir(AUDIO_DIR) if name.endswith(".partial.mp3")]